@@ -1,15 +1,167 @@
 # -*- coding: utf-8 -*-
+from collections import OrderedDict, defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.conf.urls import url
+from django.core.exceptions import PermissionDenied
 from django.contrib import admin
-from django.utils.safestring import mark_safe
-from django.utils.translation import activate
-from django.utils.translation import ugettext as _
+from django.contrib.admin.views.main import ChangeList
+from django.db.models import Max
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+from django.template.loader import select_template
+from django.template.response import TemplateResponse
+from django.urls import reverse
+from django.utils.html import format_html
+from django.utils.translation import get_language, ugettext as _
+
+from cms.models import Page
+
+from filer.models import File
+
+from .models import FilerLink2Plugin, LinkHealthState, LinkHealthSummary
+from .utils import get_page_url, prefetch_destinations
+
+
+def prefetch_pages(links):
+    """ Loads the pages the given links (with their placeholders) are embedded on and point to at once. """
+    placeholder_pages = dict(Page.placeholders.through.objects.filter(
+        placeholder_id__in={link.placeholder_id for link in links if link.placeholder_id}
+    ).values_list('placeholder_id', 'page_id'))
+    destinations = [(link.pk, None, link.page_link_id) for link in links]
+    destinations += [(None, None, page_id) for page_id in placeholder_pages.values()]
+    files, pages, states = prefetch_destinations(destinations)
+    for link in links:
+        if link.placeholder_id:
+            link.placeholder.page = pages.get(placeholder_pages.get(link.placeholder_id))
+        if link.page_link_id in pages:
+            link.page_link = pages[link.page_link_id]
+
 
-from .models import LinkHealthState
+def get_embedding_page_url(link):
+    """ Returns the url of the page a link is embedded on, None if it is not embedded on a page. """
+    page = link.placeholder.page if link.placeholder_id else None
+    if page is None:
+        return None
+    return get_page_url(page.pk, link.language, page) or ''
+
+
+class LinkStateChangeList(ChangeList):
+
+    def get_results(self, request):
+        """ Loads the pages the links are embedded on and point to for the whole result page at once. """
+        super(LinkStateChangeList, self).get_results(request)
+        prefetch_pages([state.link for state in self.result_list])
 
 
 class LinkStateAdmin(admin.ModelAdmin):
     list_display = ('link_name', 'link_to', 'state', 'on_page', 'detected')
     list_filter = ('state',)
+    list_select_related = ('link__placeholder', 'link__file')
+    change_list_template = 'cmsplugin_filer_link/linkstate_change_list.html'
+
+    def get_changelist(self, request, **kwargs):
+        return LinkStateChangeList
+
+    def get_urls(self):
+        return [
+            url(r'^dashboard/$', self.admin_site.admin_view(self.dashboard_view),
+                name='cmsplugin_filer_link2_linkhealthstate_dashboard'),
+            url(r'^incoming/$', self.admin_site.admin_view(self.incoming_view),
+                name='cmsplugin_filer_link2_linkhealthstate_incoming'),
+        ] + super(LinkStateAdmin, self).get_urls()
+
+    def get_incoming_links(self, request):
+        """ Returns the links to the page, file, host or url prefix given in the query string and a title. """
+        links = FilerLink2Plugin.objects.all()
+        try:
+            if request.GET.get('page'):
+                page = get_object_or_404(Page, pk=int(request.GET['page']))
+                return links.linking_to_page(page), _('Links to the page {}').format(page.get_title())
+            if request.GET.get('file'):
+                file = get_object_or_404(File, pk=int(request.GET['file']))
+                return links.linking_to_file(file), _('Links to the file {}').format(file.label)
+        except ValueError:
+            raise Http404
+        if request.GET.get('host'):
+            return links.linking_to_host(request.GET['host']), _('Links to {}').format(request.GET['host'])
+        if request.GET.get('url'):
+            return links.linking_to(request.GET['url']), _('Links to {}').format(request.GET['url'])
+        return links.none(), _('Incoming links')
+
+    def incoming_view(self, request):
+        """ Lists the links pointing to a page, file, host or url, e.g. before a page is unpublished or a file is
+        deleted. All lookups use the destination index of the links. """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        links, title = self.get_incoming_links(request)
+        # the public versions of the links are copies of the draft versions
+        links = links.exclude(placeholder__page__publisher_is_draft=False)
+        limit = getattr(settings, 'LINK_INCOMING_ROWS', 200)
+        shown = list(links.select_related('placeholder', 'linkhealth').order_by('pk')[:limit])
+        prefetch_pages(shown)
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            title=title,
+            total=links.count() if len(shown) == limit else len(shown),
+            links=[(link, get_embedding_page_url(link), link.get_linkstate()) for link in shown],
+            host=request.GET.get('host', ''),
+            url=request.GET.get('url', ''),
+        )
+        return TemplateResponse(request, 'cmsplugin_filer_link/incoming.html', context)
+
+    def dashboard_view(self, request):
+        """ Shows the numbers of faulty links of the last check_links run and their trend, read from the summary
+        written by check_links. """
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        summaries = LinkHealthSummary.objects.all()
+        date = summaries.aggregate(date=Max('date'))['date']
+        rows = defaultdict(list)
+        for dimension, value, count in summaries.filter(date=date).order_by('-count', 'value').values_list(
+                'dimension', 'value', 'count'):
+            rows[dimension].append((value, count))
+        limit = getattr(settings, 'LINK_HEALTH_DASHBOARD_ROWS', 20)
+
+        state_names = dict(LinkHealthState.LINK_STATES)
+        by_state = [(state_names.get(state, state), count) for state, count in rows[LinkHealthSummary.STATE]]
+        by_host = [(host, host or _('Internal'), count) for host, count in rows[LinkHealthSummary.HOST][:limit]]
+        counts = dict(rows[LinkHealthSummary.AGE])
+        by_age = [(name, counts.get(bucket, 0)) for bucket, name in LinkHealthSummary.AGE_NAMES]
+
+        page_counts = rows[LinkHealthSummary.PAGE][:limit]
+        files, pages, states = prefetch_destinations((None, None, int(page_id)) for page_id, count in page_counts)
+        language = get_language()
+        by_page = []
+        for page_id, count in page_counts:
+            page = pages.get(int(page_id))
+            if page is not None:
+                by_page.append((page.get_title(language), get_page_url(page.pk, language, page), count))
+
+        trend = OrderedDict()
+        if date:
+            since = date - timedelta(days=getattr(settings, 'LINK_HEALTH_DASHBOARD_DAYS', 30))
+            for day, state, count in summaries.filter(dimension=LinkHealthSummary.STATE, date__gt=since).order_by(
+                    '-date').values_list('date', 'value', 'count'):
+                trend.setdefault(day, {})[state] = count
+        trend = [(day, [day_counts.get(state, 0) for state, name in LinkHealthState.LINK_STATES],
+                  sum(day_counts.values())) for day, day_counts in trend.items()]
+
+        context = dict(
+            self.admin_site.each_context(request),
+            opts=self.model._meta,
+            title=_('Link health dashboard'),
+            date=date,
+            by_state=by_state,
+            by_host=by_host,
+            by_page=by_page,
+            by_age=by_age,
+            states=[name for state, name in LinkHealthState.LINK_STATES],
+            trend=trend,
+        )
+        return TemplateResponse(request, 'cmsplugin_filer_link/dashboard.html', context)
 
     def has_add_permission(self, request):
         return False
@@ -23,21 +175,44 @@ class LinkStateAdmin(admin.ModelAdmin):
     link_name.short_description = _('Link name')
 
     def on_page(self, obj):
-        activate(obj.link.language)
-        try:
-            return mark_safe('<a href="{link}" >{link}</a>'.format(link=obj.link.page.get_absolute_url()))
-        except AttributeError:
+        url = get_embedding_page_url(obj.link)
+        if url is None:
             # this can happen when a link is not embedded on a page, but e.g. in an app (e.g. AldrynNewsblog)
             return _('Not embedded on a page, but for example in an app.')
+        return format_html('<a href="{link}" >{link}</a>', link=url) if url else ''
     on_page.allow_tags = True
     on_page.short_description = _('On page')
 
     def link_to(self, obj):
         if obj.state != LinkHealthState.BAD_CONFIGURED:
-            activate(obj.link.language)
-            return mark_safe('<a href="{link}" >{link}</a>'.format(link=obj.link.get_link()))
+            return format_html('<a href="{link}" >{link}</a>', link=obj.link.get_link())
     link_to.allow_tags = True
     link_to.short_description = _('Links to')
 
 
 admin.site.register(LinkHealthState, LinkStateAdmin)
+
+
+def add_incoming_links(model_admin):
+    """ Adds a link to the links pointing to a file to the change view of a filer file admin. The change form of the
+    admin is extended, so customized file admins keep their own form. """
+    opts = model_admin.model._meta
+    original_templates = [model_admin.change_form_template] if model_admin.change_form_template else [
+        'admin/{}/{}/change_form.html'.format(opts.app_label, opts.model_name),
+        'admin/{}/change_form.html'.format(opts.app_label),
+        'admin/change_form.html',
+    ]
+    change_view = model_admin.change_view
+
+    def change_view_with_incoming_links(request, object_id, form_url='', extra_context=None):
+        extra_context = dict(extra_context or {})
+        extra_context['link2_original_template'] = select_template(original_templates).template
+        if request.user.has_perm('cmsplugin_filer_link2.change_linkhealthstate'):
+            extra_context['link2_incoming_url'] = '{}?file={}'.format(
+                reverse('admin:cmsplugin_filer_link2_linkhealthstate_incoming'), object_id)
+            extra_context['link2_incoming'] = FilerLink2Plugin.objects.filter(file=object_id).exclude(
+                placeholder__page__publisher_is_draft=False).count()
+        return change_view(request, object_id, form_url, extra_context)
+
+    model_admin.change_form_template = 'cmsplugin_filer_link/file_change_form.html'
+    model_admin.change_view = change_view_with_incoming_links
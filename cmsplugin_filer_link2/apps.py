@@ -5,3 +5,17 @@ from django.apps import AppConfig
 class Link2(AppConfig):
     name = 'cmsplugin_filer_link2'
     verbose_name = 'Link2'
+
+    def ready(self):
+        from django.contrib import admin
+        from django.db.models.signals import post_save, pre_delete
+
+        from cmsplugin_filer_link2 import signals
+        from cmsplugin_filer_link2.admin import add_incoming_links
+
+        for model in signals.get_file_models():
+            post_save.connect(signals.file_saved, sender=model, dispatch_uid='link2_file_saved')
+            pre_delete.connect(signals.file_deleted, sender=model, dispatch_uid='link2_file_deleted')
+            # the admins of all apps are registered by now, as long as django.contrib.admin is listed first
+            if admin.site.is_registered(model):
+                add_incoming_links(admin.site._registry[model])
@@ -0,0 +1,417 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import os
+import socket
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter, OrderedDict, namedtuple
+from datetime import timedelta
+from contextlib import contextmanager
+
+try:
+    from urllib.parse import urlsplit, urlunsplit
+except ImportError:  # Python 2
+    from urlparse import urlsplit, urlunsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.exceptions import (
+    ConnectionError, InvalidSchema, InvalidURL, MissingSchema, ReadTimeout, RequestException, TooManyRedirects,
+)
+
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.db.models import Case, Value, When
+from django.utils import timezone
+from django.utils.http import parse_http_date_safe
+
+from cmsplugin_filer_link2.models import LinkCheckHistory, LinkCheckLease, LinkDestination, LinkHealthState
+from cmsplugin_filer_link2.utils import get_host
+
+# returned if the server kept throttling us, the link state should be left untouched then
+THROTTLED = 'throttled'
+
+CheckResult = namedtuple('CheckResult', [
+    'state', 'status_code', 'final_url', 'etag', 'last_modified', 'latency', 'error',
+])
+# the latency (in seconds) of the response and the name of the error a request failed with are optional
+CheckResult.__new__.__defaults__ = (None, '')
+
+
+def normalize_url(url):
+    """ Returns the url in the form it is requested with, so equal destinations can be checked only once. """
+    url = url.strip()
+    LINK_DOMAIN = getattr(settings, 'LINK_DOMAIN', None)
+    if url.startswith('/') and LINK_DOMAIN:
+        url = '{}{}'.format(LINK_DOMAIN, url)
+    if not url or url.startswith('#') or url.startswith('/'):
+        return url
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    # the fragment is never sent to the server
+    return urlunsplit((scheme.lower(), netloc.lower(), path or '/', query, ''))
+
+
+def round_robin(items, key):
+    """ Orders the items so that consecutive items belong to different groups (e.g. hosts) wherever possible. """
+    groups = OrderedDict()
+    for item in items:
+        groups.setdefault(key(item), []).append(item)
+    queues = [iter(group) for group in groups.values()]
+    while queues:
+        for queue in list(queues):
+            try:
+                yield next(queue)
+            except StopIteration:
+                queues.remove(queue)
+
+
+def parse_retry_after(value):
+    """ Returns the number of seconds a Retry-After header asks us to wait or None if it cannot be parsed. """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    timestamp = parse_http_date_safe(value)
+    if timestamp is None:
+        return None
+    return max(timestamp - time.time(), 0)
+
+
+class HostScheduler(object):
+    """ Limits the number of concurrent connections and the request rate per host, so checking links in parallel
+    does not get us throttled by our own or a partner's servers. """
+
+    def __init__(self, max_connections=2, rate=None):
+        self.max_connections = max(max_connections, 1)
+        # minimum number of seconds between two requests to the same host
+        self.interval = 1.0 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.semaphores = {}
+        self.next_request = {}
+
+    @contextmanager
+    def slot(self, url):
+        host = get_host(url)
+        with self.lock:
+            semaphore = self.semaphores.setdefault(host, threading.BoundedSemaphore(self.max_connections))
+        with semaphore:
+            self.wait(host)
+            yield
+
+    def wait(self, host):
+        with self.lock:
+            now = time.time()
+            start = max(now, self.next_request.get(host, 0))
+            self.next_request[host] = start + self.interval
+        if start > now:
+            time.sleep(start - now)
+
+    def backoff(self, url, seconds):
+        """ Delays all further requests to the host of the url for the given number of seconds. """
+        host = get_host(url)
+        with self.lock:
+            self.next_request[host] = max(self.next_request.get(host, 0), time.time() + seconds)
+
+
+class RequestStats(object):
+    """ Timings of a number of requests: seconds waited for a free connection to the host, time to the first byte of
+    the response and total duration, the latter as a histogram so percentiles can be estimated with constant memory. """
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self):
+        self.requests = 0
+        self.wait = 0
+        self.ttfb = 0
+        self.total = 0
+        self.max_total = 0
+        self.buckets = [0] * (len(self.BUCKETS) + 1)
+        self.errors = Counter()
+        self.status_codes = Counter()
+
+    def add(self, wait, ttfb, total, status_code=None, error=''):
+        self.requests += 1
+        self.wait += wait
+        self.ttfb += ttfb or 0
+        self.total += total
+        self.max_total = max(self.max_total, total)
+        self.buckets[bisect_left(self.BUCKETS, total)] += 1
+        if error:
+            self.errors[error] += 1
+        if status_code:
+            self.status_codes[status_code] += 1
+
+    def percentile(self, percent):
+        """ Returns the upper bound of the histogram bucket the given percentile of all durations falls into (at most
+        the longest duration), None if it is above the largest bucket. """
+        if not self.requests:
+            return 0
+        rank = self.requests * percent / 100.0
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.buckets):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max_total)
+        return None
+
+    def as_dict(self):
+        requests = self.requests or 1
+        return {
+            'requests': self.requests,
+            'errors': dict(self.errors),
+            'status_codes': {str(code): count for code, count in self.status_codes.items()},
+            'avg_wait': self.wait / requests,
+            'avg_ttfb': self.ttfb / requests,
+            'avg_total': self.total / requests,
+            'max_total': self.max_total,
+            'p50_total': self.percentile(50),
+            'p95_total': self.percentile(95),
+            'p99_total': self.percentile(99),
+        }
+
+
+class CheckStats(object):
+    """ Collects the timings of all requests of a checker, in total and per host. """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.overall = RequestStats()
+        self.hosts = {}
+
+    def add(self, url, wait, ttfb, total, status_code=None, error=''):
+        host = get_host(url)
+        with self.lock:
+            self.overall.add(wait, ttfb, total, status_code, error)
+            self.hosts.setdefault(host, RequestStats()).add(wait, ttfb, total, status_code, error)
+
+    def elapsed(self):
+        return time.time() - self.started
+
+
+class ChunkLeases(object):
+    """ Lets several processes cooperatively work through the chunks of a run. Chunks are fixed ranges of link ids, a
+    chunk is identified by the first id of its range. Chunks of processes which did not finish them in time can be
+    claimed by others. """
+
+    def __init__(self, run, size, timeout=600):
+        self.run = run
+        self.size = size
+        self.timeout = timedelta(seconds=timeout)
+        self.owner = '{}:{}'.format(socket.gethostname(), os.getpid())
+
+    def get_start(self, pk):
+        """ Returns the first id of the chunk the given link id belongs to. """
+        return pk // self.size * self.size
+
+    def get_other_size(self):
+        """ Returns the chunk size of the run if other processes use a different one, None otherwise. """
+        return LinkCheckLease.objects.filter(run=self.run).exclude(size=self.size).values_list(
+            'size', flat=True).first()
+
+    def claim(self, start):
+        now = timezone.now()
+        try:
+            with transaction.atomic():
+                LinkCheckLease.objects.create(
+                    run=self.run, start=start, size=self.size, owner=self.owner, expires=now + self.timeout
+                )
+            return True
+        except IntegrityError:
+            # someone else claimed this chunk, take it over only if its lease expired
+            return LinkCheckLease.objects.filter(
+                run=self.run, start=start, size=self.size, finished__isnull=True, expires__lt=now
+            ).update(owner=self.owner, expires=now + self.timeout) == 1
+
+    def get_unfinished(self):
+        """ Returns the first ids of the chunks of the run which are not finished yet and when their leases expire. """
+        return list(LinkCheckLease.objects.filter(run=self.run, finished__isnull=True).values_list('start', 'expires'))
+
+    def finish(self, start):
+        LinkCheckLease.objects.filter(run=self.run, start=start, owner=self.owner).update(finished=timezone.now())
+
+    def cleanup(self, days=7):
+        LinkCheckLease.objects.filter(expires__lt=timezone.now() - timedelta(days=days)).delete()
+
+
+class LinkStateWriter(object):
+    """ Buffers the states of checked links and the results and check history of their destinations and writes them
+    in batches. """
+    destination_fields = ('destination', 'state', 'checked', 'status_code', 'final_url', 'etag', 'last_modified')
+
+    def __init__(self, batch_size=500):
+        self.batch_size = max(batch_size, 1)
+        self.states = {}
+        self.destinations = OrderedDict()
+        self.history = []
+        self.counts = Counter()
+        self.keep_history = getattr(settings, 'LINK_CHECK_HISTORY', True)
+
+    def add(self, link, state):
+        self.states[link.pk] = state
+        self.counts[state or 'ok'] += 1
+        if len(self.states) >= self.batch_size:
+            self.flush()
+
+    def add_check(self, key, result, checked):
+        """ Records the outcome of a check of the destination with the given key. """
+        if not self.keep_history:
+            return
+        self.history.append(LinkCheckHistory(
+            key=key,
+            checked=checked,
+            state=result.state,
+            status_code=result.status_code,
+            latency=int(result.latency * 1000) if result.latency is not None else None,
+            error=result.error[:50],
+        ))
+        if len(self.history) >= self.batch_size:
+            self.flush()
+
+    def add_destination(self, key, name, result, checked):
+        """ Records the result of the last check of the destination with the given key. """
+        self.destinations[key] = {
+            'destination': name[:2000],
+            'state': result.state,
+            'checked': checked,
+            'status_code': result.status_code,
+            'final_url': result.final_url[:2000],
+            'etag': result.etag[:255],
+            'last_modified': result.last_modified[:64],
+        }
+        if len(self.destinations) >= self.batch_size:
+            self.flush()
+
+    def flush_destinations(self):
+        """ Creates the records of new destinations at once and updates the existing ones in groups, one query each. """
+        existing = set(LinkDestination.objects.filter(key__in=list(self.destinations)).values_list('key', flat=True))
+        new = [LinkDestination(key=key, **values) for key, values in self.destinations.items() if key not in existing]
+        try:
+            with transaction.atomic():
+                LinkDestination.objects.bulk_create(new)
+        except IntegrityError:
+            # another process stored some of the destinations in the meantime
+            for record in new:
+                LinkDestination.objects.update_or_create(key=record.key, defaults=self.destinations[record.key])
+        existing = list(existing)
+        # small groups keep the number of query parameters within the limits of all databases
+        for i in range(0, len(existing), 50):
+            keys = existing[i:i + 50]
+            LinkDestination.objects.filter(key__in=keys).update(**{
+                name: Case(
+                    *[When(key=key, then=Value(self.destinations[key][name])) for key in keys],
+                    output_field=LinkDestination._meta.get_field(name)
+                ) for name in self.destination_fields
+            })
+
+    def flush(self):
+        if self.states:
+            with transaction.atomic():
+                LinkHealthState.objects.set_states(self.states)
+            self.states = {}
+        if self.destinations:
+            self.flush_destinations()
+            self.destinations = OrderedDict()
+        if self.history:
+            LinkCheckHistory.objects.bulk_create(self.history)
+            self.history = []
+
+
+class LinkChecker(object):
+    """ Checks urls for the availability of their destination. All requests of a checker share a pooled session, so
+    connections to the same host are kept alive and reused. """
+    user_agent = 'Link Checker - Brought to you by Blueshoe'
+
+    def __init__(self, timeout=60, use_agent=True, workers=10, retries=2, scheduler=None):
+        self.timeout = timeout
+        self.retries = max(retries, 0)
+        self.max_retry_after = getattr(settings, 'LINK_CHECK_MAX_RETRY_AFTER', 120)
+        self.scheduler = scheduler or HostScheduler()
+        self.stats = CheckStats()
+        self.session = requests.Session()
+        self.session.verify = False
+        adapter = HTTPAdapter(pool_connections=workers, pool_maxsize=workers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        if use_agent:
+            self.session.headers['User-Agent'] = self.user_agent
+
+    def close(self):
+        self.session.close()
+
+    def request(self, url, headers=None):
+        """ Asks for the headers only and falls back to a GET request for servers which reject HEAD requests. The body
+        of the GET response is never downloaded. """
+        queued = time.time()
+        with self.scheduler.slot(url):
+            started = time.time()
+            try:
+                response = self.session.head(url, timeout=self.timeout, allow_redirects=True, headers=headers)
+                response.close()
+                if response.status_code >= 400 and response.status_code != 429:
+                    response = self.session.get(url, timeout=self.timeout, stream=True, headers=headers)
+                    response.close()
+            except Exception as e:
+                self.stats.add(url, started - queued, None, time.time() - started, error=type(e).__name__)
+                raise
+        self.stats.add(url, started - queued, response.elapsed.total_seconds(), time.time() - started,
+                       response.status_code)
+        return response
+
+    def check_url(self, url):
+        return self.check(url).state
+
+    def check(self, url, etag='', last_modified=''):
+        """ Checks the url and returns a CheckResult. If validators of an earlier response are given, the request is
+        conditional and an unchanged destination is answered with status code 304 (and no state). """
+        LINK_DOMAIN = getattr(settings, 'LINK_DOMAIN', None)
+        if url.startswith('/'):
+            if not LINK_DOMAIN:
+                raise Exception('No domain for found - cannot check relative paths. Please configure LINK_DOMAIN.')
+            url = '{}{}'.format(LINK_DOMAIN, url)
+
+        if url and url.startswith('#'):
+            return CheckResult(None, None, '', '', '')
+
+        headers = {}
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
+
+        for attempt in range(self.retries + 1):
+            try:
+                r = self.request(url, headers)
+            except ReadTimeout as e:
+                return CheckResult(LinkHealthState.TIMEOUT, None, '', '', '', self.timeout, type(e).__name__)
+            except ConnectionError as e:
+                return CheckResult(LinkHealthState.SERVER_ERROR, None, '', '', '', None, type(e).__name__)
+            except TooManyRedirects as e:
+                return CheckResult(LinkHealthState.REDIRECT, None, '', '', '', None, type(e).__name__)
+            except (MissingSchema, InvalidSchema, InvalidURL, ValueError) as e:
+                # also raised for urls which cannot be parsed, e.g. http://[::1
+                return CheckResult(LinkHealthState.BAD_CONFIGURED, None, '', '', '', None, type(e).__name__)
+            except RequestException as e:
+                # e.g. a broken response body (ChunkedEncodingError, ContentDecodingError)
+                return CheckResult(LinkHealthState.SERVER_ERROR, None, '', '', '', None, type(e).__name__)
+            retry_after = parse_retry_after(r.headers.get('Retry-After'))
+            if r.status_code == 429 or (r.status_code == 503 and retry_after is not None):
+                if retry_after is None or retry_after > self.max_retry_after:
+                    retry_after = self.max_retry_after
+                self.scheduler.backoff(url, retry_after)
+                continue
+            if r.status_code == 304:
+                state = None
+            else:
+                state = {
+                    # we are only interested in bad status codes
+                    '3': LinkHealthState.REDIRECT,
+                    '4': LinkHealthState.NOT_REACHABLE,
+                    '5': LinkHealthState.SERVER_ERROR
+                }.get(str(r.status_code)[0])
+            return CheckResult(state, r.status_code, r.url if r.url != url else '',
+                               r.headers.get('ETag', ''), r.headers.get('Last-Modified', ''), r.elapsed.total_seconds())
+        # the server is still throttling us, that does not mean the link is broken
+        return CheckResult(THROTTLED, None, '', '', '')
@@ -1,7 +1,15 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import hashlib
+
+from django.conf import settings
+from django.conf.urls import url
+from django.contrib import admin
+from django.core.cache import cache
+from django.template.loader import render_to_string
 from django.templatetags.static import static
+from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext as _
 
 from cms.plugin_base import CMSPluginBase
@@ -9,6 +17,8 @@ from cms.plugin_pool import plugin_pool
 
 from .forms import FilerLink2Form
 from .models import FilerLink2Plugin as FilerLinkPluginModel
+from .utils import can_store_href, prefetch_destinations
+from .views import page_search
 
 
 class FilerLink2Plugin(CMSPluginBase):
@@ -51,8 +61,39 @@ class FilerLink2Plugin(CMSPluginBase):
         })
     )
 
+    def prefetch(self, context, instance, edit_mode):
+        """ Loads the destinations of all links in the placeholder of the instance at once when the first of them is
+        rendered and attaches them to every instance, so rendering a placeholder full of links needs a fixed number of
+        queries. """
+        request = context.get('request')
+        if request is None:
+            return
+        prefetched = getattr(request, '_link2_prefetched', None)
+        if prefetched is None:
+            prefetched = request._link2_prefetched = {}
+        key = instance.placeholder_id, instance.language
+        if key not in prefetched:
+            links = FilerLinkPluginModel.objects.filter(
+                placeholder_id=instance.placeholder_id, language=instance.language
+            ).values_list('pk', 'file_id', 'page_link_id', 'resolved_href')
+            # the destinations of links with a resolved href are not needed
+            links = [(pk, None, None) if href else (pk, file_id, page_id) for pk, file_id, page_id, href in links]
+            prefetched[key] = prefetch_destinations(links, with_states=edit_mode)
+        files, pages, states = prefetched[key]
+        if instance.file_id in files:
+            instance.file = files[instance.file_id]
+        if instance.page_link_id in pages:
+            instance.page_link = pages[instance.page_link_id]
+        if edit_mode:
+            instance.prefetched_state = states.get(instance.pk)
+
     def render(self, context, instance, placeholder):
         context = super(FilerLink2Plugin, self).render(context, instance, placeholder)
+        try:
+            edit_mode = context['request'].toolbar.edit_mode_active
+        except (KeyError, AttributeError):
+            edit_mode = False
+        self.prefetch(context, instance, edit_mode)
         link = instance.get_link()
         context.update({
             'link': link,
@@ -60,18 +101,37 @@ class FilerLink2Plugin(CMSPluginBase):
             'name': instance.name,
             'new_window': instance.new_window,
         })
-        try:
-            # check if we are in edit mode, so we show link health
-            if context['request'].toolbar.edit_mode:
-                state = instance.get_linkstate()
-                if state:
-                    context.update({
-                        'link_state': state,
-                    })
-        except (KeyError, AttributeError):
-            pass
+        # check if we are in edit mode, so we show link health
+        state = None
+        if edit_mode:
+            state = instance.get_linkstate()
+            if state:
+                context.update({
+                    'link_state': state,
+                })
+        timeout = getattr(settings, 'LINK_RENDER_CACHE_TIMEOUT', 0)
+        # signed file urls change on every render and expire, links to them are not cached
+        if timeout and can_store_href(instance):
+            key = self.get_render_cache_key(instance, link, state)
+            html = cache.get(key)
+            if html is None:
+                html = render_to_string(self.render_template, context.flatten())
+                cache.set(key, html, timeout)
+            context['link_html'] = mark_safe(html)
         return context
 
+    def get_render_cache_key(self, instance, link, state):
+        """ Every change of the link, of the href it resolves to (e.g. when the page it points to was moved or the file
+        was renamed) and of its link state results in a new key, so cached links never need to be invalidated. """
+        version = '\n'.join([instance.language, instance.changed_date.isoformat(), link, state or ''])
+        return 'link2:html:{pk}:{version}'.format(
+            pk=instance.pk, version=hashlib.sha1(version.encode('utf-8')).hexdigest())
+
+    def get_render_template(self, context, instance, placeholder):
+        if 'link_html' in context:
+            return 'cmsplugin_filer_link/link_cached.html'
+        return self.render_template
+
     def render_change_form(self, request, context, add=False, change=False, form_url='', obj=None):
         # The active destination determines which destination tab should be set to active. If the field is not set
         # yet, we make the first tab (url) active
@@ -80,6 +140,11 @@ class FilerLink2Plugin(CMSPluginBase):
         })
         return super(FilerLink2Plugin, self).render_change_form(request, context, add, change, form_url, obj)
 
+    def get_plugin_urls(self):
+        return [
+            url(r'^page-search/$', admin.site.admin_view(page_search), name='cmsplugin_filer_link2_page_search'),
+        ]
+
     def icon_src(self, instance):
         return static("cms/img/icons/plugins/link.png")
 
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.utils.translation import ugettext_lazy as _
+
+from cms.cms_toolbars import PAGE_MENU_IDENTIFIER
+from cms.toolbar_base import CMSToolbar
+from cms.toolbar_pool import toolbar_pool
+from cms.utils.urlutils import admin_reverse
+
+
+@toolbar_pool.register
+class IncomingLinksToolbar(CMSToolbar):
+
+    def post_template_populate(self):
+        # added after the page menu of django-cms was populated
+        page = self.request.current_page
+        if not page or not self.request.user.has_perm('cmsplugin_filer_link2.change_linkhealthstate'):
+            return
+        menu = self.toolbar.get_menu(PAGE_MENU_IDENTIFIER)
+        if menu is None:
+            return
+        url = '{}?page={}'.format(admin_reverse('cmsplugin_filer_link2_linkhealthstate_incoming'), page.pk)
+        menu.add_break('incoming-links-break')
+        menu.add_modal_item(_('Incoming links'), url=url)
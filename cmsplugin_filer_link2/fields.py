@@ -1,56 +1,64 @@
 # -*- coding: utf-8 -*-
-from django.conf import settings
-from cms.forms.fields import PageSelectFormField
-from cms.forms.utils import get_site_choices, get_page_choices
-from cms.forms.widgets import PageSelectWidget
+from django import forms
+from django.forms.models import ModelChoiceIterator
 from cms.models.fields import PageField
-from django.forms import Select
-# This import is needed to make sure the django-select2 settings are actually loaded. Since django-select2 uses
-# the django-appconf package to load some settings we cannot be certain the these settings are loaded when this
-# module is imported.
-from django_select2.forms import Select2Widget  # noqa
-
-
-class PageSelect2Widget(PageSelectWidget):
-
-    class Media:
-        js = ('https://code.jquery.com/jquery-2.1.4.min.js', settings.SELECT2_JS, 'django_select2/django_select2.js')
-        css = {
-            'screen': (settings.SELECT2_CSS, )
-        }
-
-    def _build_widgets(self):
-        site_choices = get_site_choices()
-        page_choices = get_page_choices()
-        self.site_choices = site_choices
-        self.choices = page_choices
-        self.widgets = (Select(choices=site_choices),
-                        Select(choices=[('', '----')]),
-                        Select(choices=self.choices, attrs={'style': "display:none;"}),
-                        )
-
-    def _build_script(self, name, value, attrs={}):
-        """Bit of a dirty workaround since there is no event we can catch to update the select2 instance. """
-        result = super(PageSelect2Widget, self)._build_script(name, value, attrs={})
-        result += """
-        <script>
-            var select2Instance = $('[name="%(name)s_1"]').select2({ dropdownAutoWidth : true });
-            setTimeout(function () {select2Instance.trigger('change')}, 300);
-        </script>
-        """ % {
-            'name': name
-        }
-        return result
-
-    def get_context(self, name, value, attrs):
-        ctx = super(PageSelect2Widget, self).get_context(name, value, attrs)
-        # del ctx['widget']['script_init']
-        return ctx
-
-
-class PageSelect2FormField(PageSelectFormField):
+from cms.utils import get_current_site
+from django_select2.forms import HeavySelect2Widget
+
+
+def get_page_label(page, title=None, site=None):
+    """ Label of a page in the page picker: its title and its path, which tells pages with the same title apart. Pages
+    of other sites are labelled with the domain of their site. """
+    if title is None:
+        title = page.get_title_obj()
+    if site is None and page is not None:
+        site = page.node.site
+    domain = site.domain if site is not None and site.pk != get_current_site().pk else ''
+    return '{} ({}/{})'.format(title.title, domain, title.path)
+
+
+class PageSelect2Widget(HeavySelect2Widget):
+    """ Searches pages as the user types (see views.page_search) and renders the selected page only, so the form does
+    not depend on the number of pages. """
+
+    def __init__(self, attrs=None, choices=(), **kwargs):
+        kwargs.setdefault('data_view', 'admin:cmsplugin_filer_link2_page_search')
+        super(PageSelect2Widget, self).__init__(attrs, choices, **kwargs)
+
+    @property
+    def media(self):
+        return forms.Media(js=('https://code.jquery.com/jquery-2.1.4.min.js',)) + super(PageSelect2Widget, self).media
+
+    def build_attrs(self, *args, **kwargs):
+        attrs = super(PageSelect2Widget, self).build_attrs(*args, **kwargs)
+        attrs['data-minimum-input-length'] = 1
+        attrs.setdefault('style', 'min-width: 300px;')
+        return attrs
+
+    def set_to_cache(self):
+        # unlike django-select2's own views, the page search does not look up the widget
+        pass
+
+    def optgroups(self, name, value, attrs=None):
+        options = [self.create_option(name, '', '', False, 0)]
+        selected = [v for v in value if v]
+        if selected and isinstance(self.choices, ModelChoiceIterator):
+            for page in self.choices.queryset.filter(pk__in=selected).select_related('node__site'):
+                options.append(self.create_option(name, page.pk, get_page_label(page), True, len(options)))
+        return [(None, options, 0)]
+
+
+class PageSelect2FormField(forms.ModelChoiceField):
     widget = PageSelect2Widget
 
+    def __init__(self, queryset, *args, **kwargs):
+        # the admin passes its raw id widget for the page link
+        kwargs.pop('widget', None)
+        super(PageSelect2FormField, self).__init__(queryset.filter(publisher_is_draft=True), *args, **kwargs)
+
+    def label_from_instance(self, obj):
+        return get_page_label(obj)
+
 
 class Select2PageField(PageField):
     default_form_class = PageSelect2FormField
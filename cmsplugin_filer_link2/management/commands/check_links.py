@@ -1,14 +1,46 @@
-import requests
+import io
+import json
+import os
+import time
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 from django.urls import NoReverseMatch
-
-from django.utils.translation import activate
-from requests.exceptions import ConnectionError, MissingSchema, InvalidSchema, ReadTimeout
+from django.utils import timezone
+from django.utils.encoding import force_text
 
 from django.conf import settings
 
-from cmsplugin_filer_link2.models import FilerLink2Plugin, LinkHealthState
+from cmsplugin_filer_link2.checker import (
+    THROTTLED, CheckResult, ChunkLeases, HostScheduler, LinkChecker, LinkStateWriter, RequestStats, get_host,
+    normalize_url, round_robin,
+)
+from cmsplugin_filer_link2.utils import prefetch_destinations
+from cmsplugin_filer_link2.models import (
+    FilerLink2Plugin, LinkCheckHistory, LinkCheckRun, LinkDestination, LinkHealthState, LinkHealthSummary,
+)
+
+
+# seconds between two looks at the unfinished chunks of a shared run
+LEASE_POLL_INTERVAL = 10
+
+# the columns needed to determine the destination of a link
+LINK_FIELDS = (
+    'cmsplugin_ptr', 'language', 'changed_date', 'url', 'file', 'page_link', 'persistent_page_link', 'mailto',
+)
+
+
+def shard(value):
+    """ Parses a shard given as N/M, e.g. 2/4 for the second of four shards. """
+    try:
+        index, count = [int(part) for part in value.split('/')]
+    except ValueError:
+        raise CommandError('Invalid shard {}, use N/M, e.g. 1/4.'.format(value))
+    if not 1 <= index <= count:
+        raise CommandError('Invalid shard {}, N must be between 1 and M.'.format(value))
+    return index, count
 
 
 class Command(BaseCommand):
@@ -17,57 +49,398 @@ class Command(BaseCommand):
     def add_arguments(self, parser):
         parser.add_argument('--timeout', default=60, type=int, nargs='?')
         parser.add_argument('--no-agent', default=False, type=bool, nargs='?')
+        parser.add_argument('--workers', '--concurrency', dest='workers', type=int,
+                            default=getattr(settings, 'LINK_CHECK_WORKERS', 10),
+                            help='Number of links which are checked concurrently.')
+        parser.add_argument('--host-connections', type=int,
+                            default=getattr(settings, 'LINK_CHECK_HOST_CONNECTIONS', 2),
+                            help='Maximum number of concurrent connections per host.')
+        parser.add_argument('--host-rate', type=float,
+                            default=getattr(settings, 'LINK_CHECK_HOST_RATE', 5),
+                            help='Maximum number of requests per second and host (0 for no limit).')
+        parser.add_argument('--retries', type=int,
+                            default=getattr(settings, 'LINK_CHECK_RETRIES', 2),
+                            help='How often a throttled request (429/503 with Retry-After) is retried.')
+        parser.add_argument('--incremental', action='store_true', default=False,
+                            help='Only check destinations which were never checked or whose last check is outdated.')
+        parser.add_argument('--ttl', type=int, default=getattr(settings, 'LINK_CHECK_TTL', 24 * 60 * 60),
+                            help='Seconds after which a healthy destination is checked again (incremental mode).')
+        parser.add_argument('--failed-ttl', type=int, default=getattr(settings, 'LINK_CHECK_FAILED_TTL', 60 * 60),
+                            help='Seconds after which a faulty destination is checked again (incremental mode).')
+        parser.add_argument('--chunk-size', type=int, default=getattr(settings, 'LINK_CHECK_CHUNK_SIZE', 1000),
+                            help='Number of links which are loaded from the database at once.')
+        parser.add_argument('--shard', type=shard, default=None,
+                            help='Only check the N-th of M partitions of all destinations, e.g. 1/4.')
+        parser.add_argument('--claim', metavar='RUN', default=None,
+                            help='Share the work with all other processes started with the same run name.')
+        parser.add_argument('--resume', action='store_true', default=False,
+                            help='Continue the last unfinished run.')
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'LINK_CHECK_BATCH_SIZE', 500),
+                            help='Number of link states which are written to the database at once.')
+        parser.add_argument('--report-json', metavar='PATH', default=getattr(settings, 'LINK_CHECK_REPORT_JSON', None),
+                            help='Write the statistics of the run to this file as JSON.')
+        parser.add_argument('--prometheus', metavar='PATH',
+                            default=getattr(settings, 'LINK_CHECK_PROMETHEUS_FILE', None),
+                            help='Write the statistics of the run to this file in the Prometheus text format, '
+                                 'e.g. for the textfile collector of the node exporter.')
 
-    def check_with_request(self, url, timeout, use_agent=True):
-        LINK_DOMAIN = getattr(settings, 'LINK_DOMAIN', None)
-        if url.startswith('/'):
-            if not LINK_DOMAIN:
-                raise Exception('No domain for found - cannot check relative paths. Please configure LINK_DOMAIN.')
-            url = '{}{}'.format(LINK_DOMAIN, url)
+    def get_destination(self, link):
+        """ Returns a hashable key of the destination a link points to. """
+        if link.file_id:
+            return 'url', normalize_url(link.file.url)
+        elif link.url:
+            return 'url', normalize_url(link.url)
+        elif link.page_link_id:
+            return 'page', (link.page_link_id, link.language)
+        elif link.persistent_page_link:
+            # the page this link pointed to was removed
+            return 'removed', None
+        elif not link.mailto:
+            # the file this link pointed to was removed
+            return 'removed', None
+        return None, None
 
-        if url and url.startswith('#'):
-            return
+    def get_destination_name(self, destination):
+        kind, target = destination
+        if kind == 'page':
+            return 'page:{}:{}'.format(*target)
+        return target
+
+    def is_fresh(self, record, now, ttl, failed_ttl):
+        """ Whether the last check of a destination is recent enough to skip it in incremental mode. """
+        if record is None:
+            return False
+        max_age = failed_ttl if record.state else ttl
+        return record.checked > now - timedelta(seconds=max_age)
 
-        headers = {}
+    def get_records(self, keys):
+        records = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            for record in LinkDestination.objects.filter(key__in=keys[i:i + 500]):
+                records[record.key] = record
+        return records
 
-        if use_agent:
-            headers['User-Agent'] = 'Link Checker - Brought to you by Blueshoe'
+    def store(self, destination, links, result, checked):
+        name = self.get_destination_name(destination)
+        key = LinkDestination.get_key(name)
+        self.writer.add_check(key, result, checked)
+        self.writer.add_destination(key, name, result, checked)
+        for link in links:
+            self.writer.add(link, result.state)
 
+    def evict(self, max_size):
+        """ Removes the records of the least recently checked destinations, so churned urls do not pile up. """
+        checked = LinkDestination.objects.order_by('-checked').values_list('checked', flat=True)
+        threshold = checked[max_size:max_size + 1]
+        if threshold:
+            LinkDestination.objects.filter(checked__lte=threshold[0]).delete()
+
+    def get_destination_host(self, item):
+        (kind, target), links = item
+        return get_host(target) if kind == 'url' else None
+
+    def check_page(self, page, language):
+        """ Checks a page whose titles are prefetched, so no query is needed. """
+        # all titles of the page are loaded, a missing one would only be looked up again
+        if page is None or language not in page.title_cache or not page.is_published(language):
+            return LinkHealthState.NOT_REACHABLE
         try:
-            r = requests.get(url, verify=False, timeout=timeout, headers=headers)
-        except ReadTimeout:
-            return LinkHealthState.TIMEOUT
-        except ConnectionError:
-            return LinkHealthState.SERVER_ERROR
-        except MissingSchema:
-            return LinkHealthState.BAD_CONFIGURED
-        except InvalidSchema:
-            return LinkHealthState.BAD_CONFIGURED
-        return {
-            # we are only interested in bad status codes
-            '3': LinkHealthState.REDIRECT,
-            '4': LinkHealthState.NOT_REACHABLE,
-            '5': LinkHealthState.SERVER_ERROR
-        }.get(str(r.status_code)[0])
+            # see if we can resolve the page this link points to
+            page.get_absolute_url(language=language)
+        except NoReverseMatch:
+            return LinkHealthState.NOT_REACHABLE
+
+    def iter_links(self, chunk_size, leases=None, last_pk=0):
+        """ Yields all links after last_pk in chunks, paginated by primary key so the memory usage does not depend on
+        the number of links. With leases only the chunks claimed by this process are yielded, see iter_claimed_links.
+        """
+        if leases is not None:
+            for item in self.iter_claimed_links(chunk_size, leases):
+                yield item
+            return
+        queryset = FilerLink2Plugin.objects.order_by('pk').select_related('file').only(*LINK_FIELDS)
+        while True:
+            chunk = list(queryset.filter(pk__gt=last_pk)[:chunk_size])
+            if not chunk:
+                return
+            last_pk = chunk[-1].pk
+            yield chunk[0].pk, chunk
+
+    def iter_claimed_links(self, chunk_size, leases):
+        """ Yields the chunks of a shared run claimed by this process. The chunks are the fixed id ranges of the leases,
+        so all processes agree on them. After all ranges were claimed, chunks of processes which did not finish them
+        are taken over once their leases expire, until the whole run is done. """
+        queryset = FilerLink2Plugin.objects.order_by('pk').select_related('file').only(*LINK_FIELDS)
+        last_pk = 0
+        while True:
+            # ranges without any link are skipped
+            first = queryset.filter(pk__gt=last_pk).values_list('pk', flat=True).first()
+            if first is None:
+                break
+            start = leases.get_start(first)
+            last_pk = start + chunk_size - 1
+            if leases.claim(start):
+                yield start, list(queryset.filter(pk__gte=start, pk__lte=last_pk))
+        while True:
+            unfinished = leases.get_unfinished()
+            if not unfinished:
+                return
+            now = timezone.now()
+            expired = [start for start, expires in unfinished if expires < now]
+            for start in expired:
+                if leases.claim(start):
+                    yield start, list(queryset.filter(pk__gte=start, pk__lt=start + chunk_size))
+            if not expired:
+                # wait for the other processes to finish their chunks or for the first of their leases to expire
+                wait = min(expires for start, expires in unfinished) - now
+                time.sleep(min(max(wait.total_seconds(), 0), LEASE_POLL_INTERVAL) + 0.1)
+
+    def in_shard(self, key, shard):
+        index, count = shard
+        return int(key, 16) % count == index - 1
+
+    def get_run(self, options):
+        shard = '{}/{}'.format(*options['shard']) if options['shard'] else ''
+        runs = LinkCheckRun.objects.filter(shard=shard)
+        # only the latest run can be resumed, results of older ones were checked again since
+        run = runs.order_by('-started', '-pk').first()
+        if options['resume'] and run and not run.finished:
+            self.stdout.write('Resuming the run started on {started} after link {pk}'.format(
+                started=run.started, pk=run.last_link))
+        else:
+            if options['resume']:
+                self.stdout.write('There is no unfinished run to resume, starting a new one')
+            run = LinkCheckRun.objects.create(shard=shard)
+        # earlier runs, finished or abandoned, are not needed anymore
+        runs.exclude(pk=run.pk).delete()
+        return run
 
     def handle(self, *args, **options):
         timeout = options['timeout']
         no_agent = options['no_agent']
+        workers = max(options['workers'], 1)
+        checker = LinkChecker(
+            timeout=timeout,
+            use_agent=not no_agent,
+            workers=workers,
+            retries=options['retries'],
+            scheduler=HostScheduler(options['host_connections'], options['host_rate']),
+        )
+        self.writer = LinkStateWriter(options['batch_size'])
+
+        chunk_size = max(options['chunk_size'], 1)
+        leases = run = None
+        if options['claim']:
+            if options['resume']:
+                raise CommandError('A claimed run is resumed by starting check_links with the same run name.')
+            leases = ChunkLeases(options['claim'], chunk_size, getattr(settings, 'LINK_CHECK_LEASE_TIMEOUT', 600))
+            other_size = leases.get_other_size()
+            if other_size is not None:
+                raise CommandError('The run {run} uses chunks of {size} links, start all its processes with the same '
+                                   '--chunk-size.'.format(run=options['claim'], size=other_size))
+            self.started = timezone.now()
+        else:
+            run = self.get_run(options)
+            self.started = run.started
+            self.writer.counts.update(run.get_counts())
+        resumed = Counter(self.writer.counts)
+
+        self.stdout.write('Checking {num} link-instances'.format(num=FilerLink2Plugin.objects.count()))
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            chunks = self.iter_links(chunk_size, leases, run.last_link if run else 0)
+            for start, chunk in chunks:
+                self.check_chunk(chunk, executor, checker, options)
+                # checkpoint: everything up to here is written and needs not to be checked again
+                self.writer.flush()
+                if leases:
+                    leases.finish(start)
+                else:
+                    run.last_link = chunk[-1].pk
+                    run.set_counts(self.writer.counts)
+                    run.save()
+        checker.close()
+        if leases:
+            leases.cleanup()
+        else:
+            run.finished = timezone.now()
+            run.save()
+
+        self.evict(getattr(settings, 'LINK_CHECK_CACHE_SIZE', 100000))
+        LinkCheckHistory.objects.prune(getattr(settings, 'LINK_CHECK_HISTORY_DAYS', 90))
+        # the numbers shown on the link health dashboard
+        LinkHealthSummary.objects.update_summary()
+
+        report = self.get_report(checker.stats, self.writer.counts - resumed)
+        self.print_report(report)
+        if options['report_json']:
+            self.write_file(options['report_json'], json.dumps(report, indent=2, sort_keys=True))
+        if options['prometheus']:
+            self.write_file(options['prometheus'], self.format_prometheus(report, checker.stats))
+
+    def check_chunk(self, links, executor, checker, options):
+        destinations = OrderedDict()
+        for link in links:
+            destinations.setdefault(self.get_destination(link), []).append(link)
+        shard = options['shard']
+        # links without a checkable destination (e.g. mailto) never get a link state
+        for link in destinations.pop((None, None), []):
+            if not options['incremental'] and (not shard or link.pk % shard[1] == shard[0] - 1):
+                self.writer.add(link, None)
+        for link in destinations.pop(('removed', None), []):
+            if not shard or link.pk % shard[1] == shard[0] - 1:
+                self.writer.add(link, LinkHealthState.NOT_REACHABLE)
+
+        now = timezone.now()
+        keys = {destination: LinkDestination.get_key(self.get_destination_name(destination))
+                for destination in destinations}
+        if shard:
+            # all links of a destination belong to the same shard, so no destination is checked twice
+            for destination, key in list(keys.items()):
+                if not self.in_shard(key, shard):
+                    del destinations[destination]
+                    del keys[destination]
+        records = self.get_records(keys.values())
+        for destination in list(destinations):
+            record = records.get(keys[destination])
+            if record and record.checked >= self.started:
+                # this destination was already checked during this run
+                for link in destinations.pop(destination):
+                    self.writer.add(link, record.state)
+            elif options['incremental'] and self.is_fresh(record, now, options['ttl'], options['failed_ttl']):
+                # links which were changed since the last check have lost their link state when they were saved
+                for link in destinations.pop(destination):
+                    if link.changed_date > record.checked:
+                        self.writer.add(link, record.state)
+
+        # the pages of the remaining page links with their titles, loaded at once for the whole chunk
+        files, pages, states = prefetch_destinations(
+            (None, None, target[0]) for kind, target in destinations if kind == 'page'
+        )
+        pending = {}
+        # spread the requests across the hosts, so the workers are not all waiting for the same host
+        for destination, links in round_robin(destinations.items(), key=self.get_destination_host):
+            kind, target = destination
+            # http requests are run by the worker threads, everything touching the database stays in this thread
+            if kind == 'url':
+                record = records.get(keys[destination])
+                if record and (record.etag or record.last_modified):
+                    future = executor.submit(checker.check, target, record.etag, record.last_modified)
+                else:
+                    future = executor.submit(checker.check, target)
+                pending[future] = destination, links, record
+            else:
+                state = self.check_page(pages.get(target[0]), target[1])
+                self.store(destination, links, CheckResult(state, None, '', '', ''), now)
+
+        for future in as_completed(pending):
+            destination, links, record = pending[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                # e.g. relative urls without LINK_DOMAIN, the links keep their state and the others are still checked
+                self.stderr.write('Could not check {}: {}'.format(destination[1], e))
+                continue
+            if result.state == THROTTLED:
+                continue
+            if result.status_code == 304:
+                # the destination did not change since the last check, so neither did its state
+                result = CheckResult(record.state, record.status_code, record.final_url, result.etag or record.etag,
+                                     result.last_modified or record.last_modified, result.latency, result.error)
+            self.store(destination, links, result, timezone.now())
+
+    def get_report(self, stats, counts):
+        """ Returns the statistics of the run: number of links per state, requests and their timings in seconds, in
+        total and per host. """
+        elapsed = stats.elapsed()
+        links = sum(counts.values())
+        return {
+            'finished': int(time.time()),
+            'duration': elapsed,
+            'links': links,
+            'states': dict(counts),
+            'links_per_second': links / elapsed if elapsed else 0,
+            'requests_per_second': stats.overall.requests / elapsed if elapsed else 0,
+            'requests': stats.overall.as_dict(),
+            'hosts': {host: host_stats.as_dict() for host, host_stats in stats.hosts.items()},
+        }
+
+    def print_report(self, report):
+        def seconds(value):
+            return '{:.3f}s'.format(value) if value is not None else 'more than {}s'.format(RequestStats.BUCKETS[-1])
+
+        requests = report['requests']
+        self.stdout.write('Checked {links} link-instances with {num} requests in {duration:.1f}s '
+                          '({links_per_second:.1f} links/s, {requests_per_second:.1f} requests/s)'.format(
+                              num=requests['requests'], **report))
+        if not requests['requests']:
+            return
+        self.stdout.write('Requests took {avg} on average, 50% at most {p50}, 95% at most {p95}, the slowest {max} '
+                          '(time to first byte {ttfb}, waited {wait} for a free connection)'.format(
+                              avg=seconds(requests['avg_total']), p50=seconds(requests['p50_total']),
+                              p95=seconds(requests['p95_total']), max=seconds(requests['max_total']),
+                              ttfb=seconds(requests['avg_ttfb']), wait=seconds(requests['avg_wait'])))
+        if requests['errors']:
+            self.stdout.write('Failed requests: {}'.format(', '.join(
+                '{} {}'.format(count, error) for error, count in sorted(requests['errors'].items()))))
+        hosts = sorted(report['hosts'].items(), key=lambda item: item[1]['avg_total'], reverse=True)
+        self.stdout.write('Slowest hosts:')
+        for host, host_stats in hosts[:10]:
+            self.stdout.write('  {host}: {num} requests, {avg} on average, 95% at most {p95}, {errors} failed'.format(
+                host=host, num=host_stats['requests'], avg=seconds(host_stats['avg_total']),
+                p95=seconds(host_stats['p95_total']), errors=sum(host_stats['errors'].values())))
+
+    def format_prometheus(self, report, stats):
+        def label(value):
+            return '"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+
+        lines = [
+            '# HELP link_check_finished_seconds Unix time when the last check_links run finished.',
+            '# TYPE link_check_finished_seconds gauge',
+            'link_check_finished_seconds {}'.format(report['finished']),
+            '# HELP link_check_duration_seconds Duration of the last check_links run.',
+            '# TYPE link_check_duration_seconds gauge',
+            'link_check_duration_seconds {}'.format(report['duration']),
+            '# HELP link_check_links Number of checked links by state.',
+            '# TYPE link_check_links gauge',
+        ]
+        lines += ['link_check_links{{state={}}} {}'.format(label(state), count)
+                  for state, count in sorted(report['states'].items())]
+        lines += [
+            '# HELP link_check_request_duration_seconds Duration of the requests of the last check_links run.',
+            '# TYPE link_check_request_duration_seconds histogram',
+        ]
+        cumulative = 0
+        for bound, count in zip(RequestStats.BUCKETS + ('+Inf',), stats.overall.buckets):
+            cumulative += count
+            lines.append('link_check_request_duration_seconds_bucket{{le="{}"}} {}'.format(bound, cumulative))
+        lines += [
+            'link_check_request_duration_seconds_sum {}'.format(stats.overall.total),
+            'link_check_request_duration_seconds_count {}'.format(stats.overall.requests),
+            '# HELP link_check_host_requests Number of requests per host of the last check_links run.',
+            '# TYPE link_check_host_requests gauge',
+        ]
+        hosts = sorted(stats.hosts.items())
+        lines += ['link_check_host_requests{{host={}}} {}'.format(label(host), host_stats.requests)
+                  for host, host_stats in hosts]
+        lines += [
+            '# HELP link_check_host_request_seconds Total duration of the requests per host of the last check_links '
+            'run.',
+            '# TYPE link_check_host_request_seconds gauge',
+        ]
+        lines += ['link_check_host_request_seconds{{host={}}} {}'.format(label(host), host_stats.total)
+                  for host, host_stats in hosts]
+        lines += [
+            '# HELP link_check_host_errors Number of failed requests per host and error of the last check_links run.',
+            '# TYPE link_check_host_errors gauge',
+        ]
+        lines += ['link_check_host_errors{{host={},error={}}} {}'.format(label(host), label(error), count)
+                  for host, host_stats in hosts for error, count in sorted(host_stats.errors.items())]
+        return '\n'.join(lines) + '\n'
 
-        all_links = FilerLink2Plugin.objects.all()
-        self.stdout.write('Checking {num} link-instances'.format(num=all_links.count()))
-
-        for link in all_links:
-            status = None
-            if link.file:
-                status = self.check_with_request(link.file.url, timeout=timeout, use_agent=not no_agent)
-            elif link.url:
-                status = self.check_with_request(link.url, timeout=timeout, use_agent=not no_agent)
-            elif link.page_link:
-                try:
-                    # see if we can resolve the page this link points to
-                    activate(link.language)
-                    link.page_link.get_absolute_url()
-                except NoReverseMatch:
-                    status = LinkHealthState.NOT_REACHABLE
-            link.set_linkstate(status)
+    def write_file(self, path, content):
+        # write to a temporary file first, so readers never see a partially written report
+        temporary = '{}.tmp'.format(path)
+        with io.open(temporary, 'w', encoding='utf-8') as f:
+            f.write(force_text(content))
+        os.rename(temporary, path)
@@ -1,26 +1,83 @@
+from collections import defaultdict
+
 from cms.models import CMSPlugin
 from cmsplugin_filer_link.models import FilerLinkPlugin
 from django.core.management.base import BaseCommand
-from django.db import transaction
+from django.db import connection, transaction
 
 from cmsplugin_filer_link2.models import FilerLink2Plugin
+from cmsplugin_filer_link2.utils import get_page_url, prefetch_destinations, refresh_hrefs
 
 
 class Command(BaseCommand):
     help = 'Migrate all FilerLinkPlugin to FilerLink2Plugins'
 
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=1000,
+                            help='Number of links which are migrated in one transaction.')
+
+    def get_insert_sql(self):
+        """ Returns the statement which copies a range of old links to the table of the new links. Columns which only
+        exist in the new table are set to their default. """
+        qn = connection.ops.quote_name
+        old_columns = set(field.column for field in FilerLinkPlugin._meta.local_concrete_fields)
+        columns, values, params = [], [], []
+        for field in FilerLink2Plugin._meta.local_concrete_fields:
+            columns.append(qn(field.column))
+            if field.column in old_columns:
+                values.append(qn(field.column))
+            else:
+                values.append('%s')
+                params.append(field.get_db_prep_save(field.get_default(), connection))
+        sql = 'INSERT INTO {new} ({columns}) SELECT {values} FROM {old} WHERE {pk} >= %s AND {pk} <= %s'.format(
+            new=qn(FilerLink2Plugin._meta.db_table),
+            old=qn(FilerLinkPlugin._meta.db_table),
+            pk=qn(FilerLinkPlugin._meta.pk.column),
+            columns=', '.join(columns),
+            values=', '.join(values),
+        )
+        return sql, params
+
     def handle(self, *args, **options):
-        old_links = FilerLinkPlugin.objects.all()
-        self.stdout.write('Migrating {num} FilerLinkPlugin objects to FilerLink2Plugins'.format(num=old_links.count()))
-
-        with transaction.atomic():
-            for old_link in old_links:
-                cmsplugin = CMSPlugin.objects.get(id=old_link.cmsplugin_ptr_id)
-                FilerLinkPlugin.objects.filter(id=old_link.id).delete()
-
-                link = FilerLink2Plugin(cmsplugin_ptr=cmsplugin)
-                link.__dict__.update(old_link.__dict__)
-                link.plugin_type = 'FilerLink2Plugin'
-                link.save()
-                link.parent.numchild += 1
-                link.parent.save()
+        old_links = FilerLinkPlugin.objects.order_by('pk')
+        total = old_links.count()
+        self.stdout.write('Migrating {num} FilerLinkPlugin objects to FilerLink2Plugins'.format(num=total))
+
+        insert_sql, insert_params = self.get_insert_sql()
+        delete_sql = 'DELETE FROM {old} WHERE {pk} >= %s AND {pk} <= %s'.format(
+            old=connection.ops.quote_name(FilerLinkPlugin._meta.db_table),
+            pk=connection.ops.quote_name(FilerLinkPlugin._meta.pk.column),
+        )
+        chunk_size = max(options['chunk_size'], 1)
+        migrated = 0
+        while True:
+            # migrated links are removed from the old table, so the next chunk always starts at its beginning
+            pks = list(old_links.values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                break
+            with transaction.atomic():
+                with connection.cursor() as cursor:
+                    cursor.execute(insert_sql, insert_params + [pks[0], pks[-1]])
+                    # only the rows of the old plugin are removed, the cms plugins (and their position in the plugin
+                    # tree) are kept as they are
+                    cursor.execute(delete_sql, [pks[0], pks[-1]])
+                CMSPlugin.objects.filter(pk__gte=pks[0], pk__lte=pks[-1], plugin_type='FilerLinkPlugin').update(
+                    plugin_type='FilerLink2Plugin'
+                )
+                links = FilerLink2Plugin.objects.filter(pk__gte=pks[0], pk__lte=pks[-1])
+                self.persist_page_links(links)
+                refresh_hrefs(links)
+            migrated += len(pks)
+            self.stdout.write('Migrated {migrated} of {total} links'.format(migrated=migrated, total=total))
+
+    def persist_page_links(self, links):
+        """ Stores the internal urls of the page links, like FilerLink2Plugin.save() does. """
+        links = list(links.filter(page_link__isnull=False).values_list('pk', 'page_link_id', 'language'))
+        files, pages, states = prefetch_destinations((pk, None, page_id) for pk, page_id, language in links)
+        urls = defaultdict(list)
+        for pk, page_id, language in links:
+            url = get_page_url(page_id, language, pages.get(page_id))
+            if url:
+                urls[url].append(pk)
+        for url, link_ids in urls.items():
+            FilerLink2Plugin.objects.filter(pk__in=link_ids).update(persistent_page_link=url)
@@ -0,0 +1,18 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from cmsplugin_filer_link2.models import LinkCheckHistory
+
+
+class Command(BaseCommand):
+    help = 'Remove old checks from the link check history'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=getattr(settings, 'LINK_CHECK_HISTORY_DAYS', 90),
+                            help='Number of days the checks are kept.')
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help='Number of checks which are removed at once.')
+
+    def handle(self, *args, **options):
+        removed = LinkCheckHistory.objects.prune(max(options['days'], 0), max(options['batch_size'], 1))
+        self.stdout.write('Removed {num} checks'.format(num=removed))
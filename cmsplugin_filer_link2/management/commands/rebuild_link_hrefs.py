@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from cmsplugin_filer_link2.models import FilerLink2Plugin
+from cmsplugin_filer_link2.utils import refresh_hrefs
+
+
+class Command(BaseCommand):
+    help = 'Resolve the hrefs of all links again'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of links which are loaded and updated at once.')
+
+    def handle(self, *args, **options):
+        links = FilerLink2Plugin.objects.all()
+        self.stdout.write('Resolving the hrefs of {num} link-instances'.format(num=links.count()))
+        updated = refresh_hrefs(links, max(options['chunk_size'], 1))
+        self.stdout.write('Updated {num} hrefs'.format(num=updated))
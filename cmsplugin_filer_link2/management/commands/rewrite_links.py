@@ -0,0 +1,42 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from cmsplugin_filer_link2.models import FilerLink2Plugin
+
+
+class Command(BaseCommand):
+    help = 'Replace the beginning of the urls and internal urls of links, e.g. when a domain or page moved'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--from', dest='prefix', required=True,
+                            help='The beginning of the urls which is replaced, e.g. https://old.example.com/')
+        parser.add_argument('--to', dest='replacement', required=True,
+                            help='The replacement, e.g. https://www.example.com/')
+        parser.add_argument('--dry-run', action='store_true', default=False,
+                            help='Only report which links would be changed.')
+        parser.add_argument('--show', type=int, default=20,
+                            help='Number of changes which are listed in a dry run.')
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help='Number of links which are updated at once.')
+
+    def handle(self, *args, **options):
+        prefix, replacement = options['prefix'], options['replacement']
+        if not prefix:
+            raise CommandError('--from must not be empty.')
+        links = FilerLink2Plugin.objects.rewritable(prefix)
+        if options['dry_run']:
+            self.report(links, prefix, replacement, options['show'])
+            return
+        rewritten = links.rewrite(prefix, replacement, max(options['chunk_size'], 1))
+        self.stdout.write('Rewrote {num} link-instances'.format(num=rewritten))
+
+    def report(self, links, prefix, replacement, show):
+        self.stdout.write('{num} link-instances would be rewritten'.format(num=links.count()))
+        self.stdout.write('  {num} by their url'.format(num=links.filter(url__startswith=prefix).count()))
+        # only the internal urls of links to removed pages are rewritten
+        self.stdout.write('  {num} by their persistent_page_link'.format(
+            num=links.filter(persistent_page_link__startswith=prefix, page_link=None).count()))
+        changes = links.order_by('pk').values_list('pk', 'language', 'name', 'url', 'persistent_page_link')[:show]
+        for pk, language, name, url, persistent_page_link in changes:
+            old = url if url and url.startswith(prefix) else persistent_page_link
+            self.stdout.write('  #{pk} {name} ({language}): {old} -> {new}'.format(
+                pk=pk, name=name, language=language, old=old, new=replacement + old[len(prefix):]))
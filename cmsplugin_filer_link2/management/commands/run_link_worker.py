@@ -0,0 +1,55 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.utils import timezone
+
+from cmsplugin_filer_link2.checker import HostScheduler, LinkChecker, LinkStateWriter
+from cmsplugin_filer_link2.management.commands.check_links import LINK_FIELDS, Command as CheckLinksCommand
+from cmsplugin_filer_link2.models import FilerLink2Plugin, LinkCheckTask
+
+
+class Command(CheckLinksCommand):
+    help = 'Check links which were changed by editors as soon as they were saved'
+
+    def add_arguments(self, parser):
+        super(Command, self).add_arguments(parser)
+        parser.add_argument('--interval', type=float, default=2,
+                            help='Seconds to wait for new tasks when the queue is empty.')
+        parser.add_argument('--once', action='store_true', default=False,
+                            help='Exit as soon as the queue is empty.')
+
+    def handle(self, *args, **options):
+        workers = max(options['workers'], 1)
+        checker = LinkChecker(
+            timeout=options['timeout'],
+            use_agent=not options['no_agent'],
+            workers=workers,
+            retries=options['retries'],
+            scheduler=HostScheduler(options['host_connections'], options['host_rate']),
+        )
+        self.writer = LinkStateWriter(options['batch_size'])
+        # destinations whose last check is still fresh are not checked again, the changed links get their state
+        options.update(incremental=True, shard=None)
+        chunk_size = max(options['chunk_size'], 1)
+
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                self.started = timezone.now()
+                tasks = list(LinkCheckTask.objects.order_by('created').values_list('link_id', flat=True)[:chunk_size])
+                if not tasks:
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+                    continue
+                links = FilerLink2Plugin.objects.filter(pk__in=tasks).select_related('file')
+                try:
+                    self.check_chunk(list(links.only(*LINK_FIELDS)), executor, checker, options)
+                    self.writer.flush()
+                except Exception as e:
+                    # the tasks are dropped, otherwise the worker would fail on them again and again
+                    self.stderr.write('Checking the changed links {} failed: {!r}'.format(tasks, e))
+                    self.writer = LinkStateWriter(options['batch_size'])
+                # links which were saved again in the meantime stay in the queue
+                LinkCheckTask.objects.filter(link__in=tasks, created__lte=self.started).delete()
+                self.stdout.write('Checked {num} changed link-instances'.format(num=len(tasks)))
+        checker.close()
@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 08:12
+
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmsplugin_filer_link2', '0010_auto_20200325_0735'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LinkDestination',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=40, unique=True, verbose_name='key')),
+                ('destination', models.CharField(max_length=2000, verbose_name='destination')),
+                ('state', models.CharField(blank=True, choices=[('3xx', 'Redirected'), ('4xx', 'Not reachable'), ('5xx', 'Server error'), ('bad', 'Bad configured'), ('to', 'Timeout')], max_length=3, null=True, verbose_name='State')),
+                ('checked', models.DateTimeField(db_index=True, verbose_name='Checked on')),
+            ],
+            options={
+                'verbose_name': 'Link destination',
+                'verbose_name_plural': 'Link destinations',
+            },
+        ),
+    ]
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 08:12
+
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmsplugin_filer_link2', '0011_linkdestination'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='linkdestination',
+            name='etag',
+            field=models.CharField(blank=True, max_length=255, verbose_name='ETag'),
+        ),
+        migrations.AddField(
+            model_name='linkdestination',
+            name='final_url',
+            field=models.CharField(blank=True, max_length=2000, verbose_name='final url'),
+        ),
+        migrations.AddField(
+            model_name='linkdestination',
+            name='last_modified',
+            field=models.CharField(blank=True, max_length=64, verbose_name='last modified'),
+        ),
+        migrations.AddField(
+            model_name='linkdestination',
+            name='status_code',
+            field=models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='status code'),
+        ),
+    ]
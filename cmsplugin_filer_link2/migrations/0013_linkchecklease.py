@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 08:15
+
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmsplugin_filer_link2', '0012_linkdestination_validators'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LinkCheckLease',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('run', models.CharField(max_length=100, verbose_name='run')),
+                ('start', models.PositiveIntegerField(verbose_name='first link id')),
+                ('size', models.PositiveIntegerField(default=0, verbose_name='chunk size')),
+                ('owner', models.CharField(max_length=255, verbose_name='owner')),
+                ('expires', models.DateTimeField(verbose_name='expires')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='finished')),
+            ],
+            options={
+                'verbose_name': 'Link check lease',
+                'verbose_name_plural': 'Link check leases',
+                'unique_together': {('run', 'start')},
+            },
+        ),
+    ]
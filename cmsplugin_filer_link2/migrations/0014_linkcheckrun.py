@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 08:15
+
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmsplugin_filer_link2', '0013_linkchecklease'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LinkCheckRun',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('started', models.DateTimeField(auto_now_add=True, verbose_name='started')),
+                ('finished', models.DateTimeField(blank=True, null=True, verbose_name='finished')),
+                ('shard', models.CharField(blank=True, max_length=20, verbose_name='shard')),
+                ('last_link', models.PositiveIntegerField(default=0, verbose_name='last processed link id')),
+                ('counts', models.TextField(default='{}', verbose_name='number of links per state')),
+            ],
+            options={
+                'verbose_name': 'Link check run',
+                'verbose_name_plural': 'Link check runs',
+            },
+        ),
+    ]
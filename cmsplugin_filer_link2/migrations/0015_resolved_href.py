@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 08:19
+
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmsplugin_filer_link2', '0014_linkcheckrun'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filerlink2plugin',
+            name='resolved_href',
+            field=models.TextField(blank=True, editable=False, verbose_name='resolved link'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 08:20
+
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmsplugin_filer_link2', '0015_resolved_href'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LinkCheckTask',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('created', models.DateTimeField(db_index=True, verbose_name='created')),
+                ('link', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='checktask', to='cmsplugin_filer_link2.FilerLink2Plugin', verbose_name='Link name')),
+            ],
+            options={
+                'verbose_name': 'Link check task',
+                'verbose_name_plural': 'Link check tasks',
+            },
+        ),
+    ]
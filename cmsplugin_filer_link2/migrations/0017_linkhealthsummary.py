@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 08:24
+
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmsplugin_filer_link2', '0016_linkchecktask'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='linkhealthstate',
+            name='detected',
+            field=models.DateTimeField(auto_now=True, db_index=True, help_text='Date and time when the faulty link state was detected.', verbose_name='Detected on'),
+        ),
+        migrations.AlterField(
+            model_name='linkhealthstate',
+            name='state',
+            field=models.CharField(choices=[('3xx', 'Redirected'), ('4xx', 'Not reachable'), ('5xx', 'Server error'), ('bad', 'Bad configured'), ('to', 'Timeout')], db_index=True, max_length=3, verbose_name='State'),
+        ),
+        migrations.CreateModel(
+            name='LinkHealthSummary',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='date')),
+                ('dimension', models.CharField(choices=[('state', 'State'), ('host', 'Host'), ('page', 'Page'), ('age', 'Age')], max_length=5, verbose_name='dimension')),
+                ('value', models.CharField(blank=True, max_length=255, verbose_name='value')),
+                ('count', models.PositiveIntegerField(verbose_name='number of links')),
+            ],
+            options={
+                'verbose_name': 'Link health summary',
+                'verbose_name_plural': 'Link health summaries',
+                'unique_together': {('date', 'dimension', 'value')},
+            },
+        ),
+    ]
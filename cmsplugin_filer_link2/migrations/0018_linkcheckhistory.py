@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 08:26
+
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmsplugin_filer_link2', '0017_linkhealthsummary'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LinkCheckHistory',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('key', models.CharField(max_length=40, verbose_name='key')),
+                ('checked', models.DateTimeField(db_index=True, verbose_name='Checked on')),
+                ('state', models.CharField(blank=True, choices=[('3xx', 'Redirected'), ('4xx', 'Not reachable'), ('5xx', 'Server error'), ('bad', 'Bad configured'), ('to', 'Timeout')], max_length=3, null=True, verbose_name='State')),
+                ('status_code', models.PositiveSmallIntegerField(blank=True, null=True, verbose_name='status code')),
+                ('latency', models.PositiveIntegerField(blank=True, null=True, verbose_name='latency in milliseconds')),
+                ('error', models.CharField(blank=True, max_length=50, verbose_name='error')),
+            ],
+            options={
+                'verbose_name': 'Link check',
+                'verbose_name_plural': 'Link check history',
+                'index_together': {('key', 'checked')},
+            },
+        ),
+    ]
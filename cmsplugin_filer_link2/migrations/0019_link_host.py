@@ -0,0 +1,41 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 08:31
+
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # Python 2
+    from urlparse import urlsplit
+
+
+def set_hosts(apps, schema_editor):
+    FilerLink2Plugin = apps.get_model('cmsplugin_filer_link2', 'FilerLink2Plugin')
+    hosts = defaultdict(list)
+    for pk, href, url in FilerLink2Plugin.objects.values_list('pk', 'resolved_href', 'url').iterator():
+        host = urlsplit(href or url or '').netloc.lower()[:255]
+        if host:
+            hosts[host].append(pk)
+    for host, pks in hosts.items():
+        for i in range(0, len(pks), 500):
+            FilerLink2Plugin.objects.filter(pk__in=pks[i:i + 500]).update(host=host)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmsplugin_filer_link2', '0018_linkcheckhistory'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filerlink2plugin',
+            name='host',
+            field=models.CharField(blank=True, editable=False, max_length=255, verbose_name='host'),
+        ),
+        migrations.RunPython(set_hosts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 2.2.28 on 2026-10-18 08:32
+
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.db import migrations, models
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # Python 2
+    from urlparse import urlsplit
+
+
+def set_paths(apps, schema_editor):
+    FilerLink2Plugin = apps.get_model('cmsplugin_filer_link2', 'FilerLink2Plugin')
+    paths = defaultdict(list)
+    links = FilerLink2Plugin.objects.values_list('pk', 'resolved_href', 'url', 'persistent_page_link')
+    for pk, href, url, persistent_page_link in links.iterator():
+        # links saved before the hrefs were stored have none, their url or internal url is used like in 0019
+        parts = urlsplit(href or url or persistent_page_link or '')
+        if parts.path and parts.scheme in ('', 'http', 'https'):
+            paths[parts.path[:255]].append(pk)
+    for path, pks in paths.items():
+        for i in range(0, len(pks), 500):
+            FilerLink2Plugin.objects.filter(pk__in=pks[i:i + 500]).update(url_path=path)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cmsplugin_filer_link2', '0019_link_host'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='filerlink2plugin',
+            name='url_path',
+            field=models.CharField(blank=True, editable=False, max_length=255, verbose_name='path'),
+        ),
+        migrations.AlterIndexTogether(
+            name='filerlink2plugin',
+            index_together={('host', 'url_path')},
+        ),
+        migrations.RunPython(set_paths, migrations.RunPython.noop),
+    ]
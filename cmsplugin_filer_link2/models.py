@@ -1,21 +1,37 @@
 # -*- coding: utf-8 -*-
 from __future__ import unicode_literals
 
+import hashlib
+import json
+from collections import defaultdict
+from datetime import timedelta
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # Python 2
+    from urlparse import urlsplit
+
 from django.core.exceptions import ObjectDoesNotExist, ValidationError
 from django.urls import NoReverseMatch
-from django.db import models
+from django.db import IntegrityError, models, transaction
+from django.db.models import Case, Count, Value, When
+from django.db.models.functions import Concat, Substr
+from django.utils import timezone
+from django.utils.encoding import force_text
 from django.utils.html import escape
 from django.utils.safestring import mark_safe
 from django.utils.translation import ugettext_lazy as _
 from django.conf import settings
 
-from cms.models import CMSPlugin
+from cms.cache import invalidate_cms_page_cache
+from cms.models import CMSPlugin, Placeholder
 
 from filer.fields.file import FilerFileField
 
 from djangocms_attributes_field.fields import AttributesField
 
 from cmsplugin_filer_link2.fields import Select2PageField
+from cmsplugin_filer_link2.utils import can_store_href, get_host, get_page_url, get_path, is_cached, refresh_hrefs
 from cmsplugin_filer_link2.validators import validate_anchor_id
 
 DEFULT_LINK_STYLES = (
@@ -27,6 +43,82 @@ LINK_STYLES = getattr(settings, "FILER_LINK_STYLES", DEFULT_LINK_STYLES)
 EXCLUDED_KEYS = ['class', 'href', 'target', ]
 
 
+class FilerLink2PluginQuerySet(models.QuerySet):
+
+    def linking_to(self, prefix):
+        """ Returns the links whose url or internal url starts with the given prefix, e.g. https://www.partner.com or
+        /about-us/. If the prefix contains the complete host, the links are looked up by their indexed host and path
+        first. """
+        links = self.filter(models.Q(url__startswith=prefix) | models.Q(persistent_page_link__startswith=prefix))
+        parts = urlsplit(prefix)
+        if parts.netloc:
+            rest = prefix.split(parts.netloc, 1)[1]
+            if rest[:1] in ('/', '?', '#'):
+                return links.filter(host=get_host(prefix), url_path__startswith=get_path(prefix))
+            if not rest:
+                # the host may go on, e.g. https://www.partner.com matches https://www.partner.com:8080/ as well
+                return links.filter(host__startswith=parts.netloc.lower())
+        elif not parts.scheme and prefix.startswith('/'):
+            # relative urls have no host
+            return links.filter(host='', url_path__startswith=get_path(prefix))
+        # e.g. http:// or mailto:
+        return links
+
+    def rewritable(self, prefix):
+        """ Returns the links rewrite() changes for the given prefix. Links to existing pages follow their page, their
+        internal url is only rewritten once the page was removed. """
+        return self.linking_to(prefix).filter(
+            models.Q(url__startswith=prefix) | models.Q(persistent_page_link__startswith=prefix, page_link__isnull=True)
+        )
+
+    def linking_to_host(self, host):
+        return self.filter(host=host.lower())
+
+    def linking_to_page(self, page):
+        """ Returns the links to the draft or public version of the page. """
+        return self.filter(page_link__in=[page_id for page_id in (page.pk, page.publisher_public_id) if page_id])
+
+    def linking_to_file(self, file):
+        return self.filter(file=file)
+
+    def rewrite(self, prefix, replacement, chunk_size=500):
+        """ Replaces the prefix of the urls and internal urls of the links starting with it, e.g. when a partner moved
+        to another domain. The links are updated in chunks with a few queries each instead of being saved one by one,
+        they lose their link state and are queued for run_link_worker like saved links.
+        :return: number of rewritten links
+        """
+        links = self.rewritable(prefix).order_by('pk')
+        last_pk = 0
+        rewritten = 0
+        while True:
+            pks = list(links.filter(pk__gt=last_pk).values_list('pk', flat=True)[:chunk_size])
+            if not pks:
+                break
+            last_pk = pks[-1]
+            chunk = FilerLink2Plugin.objects.filter(pk__in=pks)
+            with transaction.atomic():
+                for field, links_of_field in (('url', chunk), ('persistent_page_link', chunk.filter(page_link=None))):
+                    links_of_field.filter(**{'{}__startswith'.format(field): prefix}).update(**{field: Concat(
+                        Value(replacement), Substr(field, len(prefix) + 1), output_field=models.CharField()
+                    )})
+                CMSPlugin.objects.filter(pk__in=pks).update(changed_date=timezone.now())
+                refresh_hrefs(chunk)
+                LinkHealthState.objects.filter(link__in=pks).delete()
+                if getattr(settings, 'LINK_CHECK_ON_SAVE', True):
+                    LinkCheckTask.objects.queue(pks)
+            # the rendered links are cached by django-cms as part of their placeholders
+            languages = defaultdict(set)
+            for placeholder_id, language in chunk.values_list('placeholder_id', 'language').distinct():
+                languages[placeholder_id].add(language)
+            for placeholder in Placeholder.objects.filter(pk__in=list(languages)):
+                for language in languages[placeholder.pk]:
+                    placeholder.clear_cache(language)
+            rewritten += len(pks)
+        if rewritten:
+            invalidate_cms_page_cache()
+        return rewritten
+
+
 class FilerLink2Plugin(CMSPlugin):
     name = models.CharField(_('name'), max_length=255)
     url = models.URLField(_('url'), blank=True, null=True, max_length=2000,
@@ -58,6 +150,12 @@ class FilerLink2Plugin(CMSPlugin):
         validators=[validate_anchor_id]
     )
 
+    # the final href of the link, kept up to date on save and by the signal handlers in signals.py
+    resolved_href = models.TextField(_('resolved link'), blank=True, editable=False)
+    # host and path of the resolved href, an index of the destinations of all links
+    host = models.CharField(_('host'), max_length=255, blank=True, editable=False)
+    url_path = models.CharField(_('path'), max_length=255, blank=True, editable=False)
+
     cmsplugin_ptr = models.OneToOneField(
         to=CMSPlugin,
         related_name='%(app_label)s_%(class)s',
@@ -65,6 +163,8 @@ class FilerLink2Plugin(CMSPlugin):
         on_delete=models.CASCADE
     )
 
+    objects = FilerLink2PluginQuerySet.as_manager()
+
     def __str__(self):
         return self.name
 
@@ -80,9 +180,22 @@ class FilerLink2Plugin(CMSPlugin):
                 _('Please only choose one destination! You set: {}'.format(', '.join(configured_destinations))))
 
     def save(self, *args, **kwargs):
+        if self.page_link_id:
+            # persist the internal url, so the link still points to it if the page is removed
+            try:
+                self.persistent_page_link = self.page_link.get_absolute_url(language=self.language)
+            except NoReverseMatch:
+                pass
+        href = self.resolve_link()
+        self.resolved_href = href if can_store_href(self) else ''
+        self.host = get_host(href)
+        self.url_path = get_path(href)
         super(FilerLink2Plugin, self).save(*args, **kwargs)
         # delete link health state
         LinkHealthState.objects.filter(link=self).delete()
+        if getattr(settings, 'LINK_CHECK_ON_SAVE', True):
+            # the link is checked again by run_link_worker
+            LinkCheckTask.objects.queue([self.pk])
 
     def get_encrypted_mailto(self):
         name, domain = self.mailto.split('@')
@@ -98,6 +211,9 @@ class FilerLink2Plugin(CMSPlugin):
             return self.name
 
     def get_link(self):
+        return self.resolved_href or self.resolve_link()
+
+    def resolve_link(self):
         if self.file:
             link = self.file.url
         elif self.mailto:
@@ -107,29 +223,21 @@ class FilerLink2Plugin(CMSPlugin):
                 link = 'mailto:{}'.format(_(self.mailto))
         elif self.url:
             link = _(self.url)
-        elif self.page_link:
-            try:
-                link = self.page_link.get_absolute_url()
-            except NoReverseMatch:
-                # if this internal link doesn't work anymore, we mark it not reachable
-                self.set_linkstate(LinkHealthState.NOT_REACHABLE)
-                # return old internal link and send user to 404
-                link = self.persistent_page_link
-            else:
-                # check if the target page has been moved or renamed and update accordingly
-                if link != self.persistent_page_link:
-                    self.persistent_page_link = link
-                    self.save()
+        elif self.page_link_id:
+            # moved, renamed, unpublished and removed pages are handled by the signal handlers in signals.py, rendering
+            # a link never writes to the database
+            # return old internal link and send user to 404 if the url of the page cannot be resolved anymore
+            page = self.page_link if is_cached(self, 'page_link') else None
+            link = get_page_url(self.page_link_id, self.language, page) or self.persistent_page_link
         elif self.persistent_page_link:
             # happens when this link instance pointed to a removed page
-            self.set_linkstate(LinkHealthState.NOT_REACHABLE)
             link = self.persistent_page_link
         else:
             link = ''
         # Append anchor ID to url
         if self.anchor_id:
             link += '#{}'.format(self.anchor_id)
-        return link or ''
+        return force_text(link or '')
 
     def set_linkstate(self, state):
         if state is None:
@@ -138,6 +246,9 @@ class FilerLink2Plugin(CMSPlugin):
             LinkHealthState.objects.update_or_create(link=self, defaults={'state': state})
 
     def get_linkstate(self):
+        if hasattr(self, 'prefetched_state'):
+            # set by the plugin while rendering, None if the link has no state
+            return self.prefetched_state.state if self.prefetched_state else None
         try:
             return self.linkhealth.state
         except ObjectDoesNotExist:
@@ -156,6 +267,34 @@ class FilerLink2Plugin(CMSPlugin):
             return None
         return configured_destinations[0]
 
+    class Meta:
+        index_together = (('host', 'url_path'),)
+
+
+class LinkHealthStateManager(models.Manager):
+
+    def set_states(self, states):
+        """ Sets the states of many links at once with a fixed number of queries. A state of None removes the link
+        state.
+        :param states: dict of link id -> state
+        """
+        healthy = [link_id for link_id, state in states.items() if state is None]
+        if healthy:
+            self.filter(link_id__in=healthy).delete()
+        faulty = {link_id: state for link_id, state in states.items() if state is not None}
+        if not faulty:
+            return
+        existing = set(self.filter(link_id__in=list(faulty)).values_list('link_id', flat=True))
+        changed = defaultdict(list)
+        for link_id in existing:
+            changed[faulty[link_id]].append(link_id)
+        now = timezone.now()
+        for state, link_ids in changed.items():
+            # links which keep their state keep the date it was detected on
+            self.filter(link_id__in=link_ids).exclude(state=state).update(state=state, detected=now)
+        self.bulk_create([self.model(link_id=link_id, state=state)
+                          for link_id, state in faulty.items() if link_id not in existing])
+
 
 class LinkHealthState(models.Model):
     NOT_REACHABLE = '4xx'
@@ -174,13 +313,232 @@ class LinkHealthState(models.Model):
 
     link = models.OneToOneField(FilerLink2Plugin, unique=True, related_name='linkhealth',
                                 verbose_name=_('Link name'), on_delete=models.CASCADE)
-    state = models.CharField(max_length=3, choices=LINK_STATES, verbose_name=_('State'))
-    detected = models.DateTimeField(auto_now=True, verbose_name=_('Detected on'),
+    state = models.CharField(max_length=3, choices=LINK_STATES, verbose_name=_('State'), db_index=True)
+    detected = models.DateTimeField(auto_now=True, verbose_name=_('Detected on'), db_index=True,
                                     help_text=_('Date and time when the faulty link state was detected.'))
 
+    objects = LinkHealthStateManager()
+
     def __str__(self):
         return _(u'Link state for: {}').format(self.link.name)
 
     class Meta:
         verbose_name = _('Link Health State')
         verbose_name_plural = _('Link Health States')
+
+
+class LinkDestination(models.Model):
+    """ Result of the last check of a destination, shared by all links pointing to it. """
+    key = models.CharField(_('key'), max_length=40, unique=True)
+    destination = models.CharField(_('destination'), max_length=2000)
+    state = models.CharField(_('State'), max_length=3, choices=LinkHealthState.LINK_STATES, blank=True, null=True)
+    checked = models.DateTimeField(_('Checked on'), db_index=True)
+    # validators and result of the last response, used to re-validate the destination with a conditional request
+    status_code = models.PositiveSmallIntegerField(_('status code'), blank=True, null=True)
+    final_url = models.CharField(_('final url'), max_length=2000, blank=True)
+    etag = models.CharField(_('ETag'), max_length=255, blank=True)
+    last_modified = models.CharField(_('last modified'), max_length=64, blank=True)
+
+    def __str__(self):
+        return self.destination
+
+    @staticmethod
+    def get_key(destination):
+        return hashlib.sha1(destination.encode('utf-8')).hexdigest()
+
+    def get_history(self):
+        return LinkCheckHistory.objects.filter(key=self.key).order_by('-checked')
+
+    class Meta:
+        verbose_name = _('Link destination')
+        verbose_name_plural = _('Link destinations')
+
+
+class LinkCheckHistoryManager(models.Manager):
+
+    def prune(self, days, batch_size=1000):
+        """ Removes the checks older than the given number of days in small batches, so pruning a large history does
+        not lock the table for long.
+        :return: number of removed checks
+        """
+        threshold = timezone.now() - timedelta(days=days)
+        removed = 0
+        while True:
+            pks = list(self.filter(checked__lt=threshold).order_by('checked').values_list('pk', flat=True)[:batch_size])
+            if not pks:
+                return removed
+            removed += self.filter(pk__in=pks).delete()[0]
+
+
+class LinkCheckHistory(models.Model):
+    """ Outcome of a single check of a destination. Rows are only ever added, prune_link_history removes old ones. """
+    key = models.CharField(_('key'), max_length=40)
+    checked = models.DateTimeField(_('Checked on'), db_index=True)
+    state = models.CharField(_('State'), max_length=3, choices=LinkHealthState.LINK_STATES, blank=True, null=True)
+    status_code = models.PositiveSmallIntegerField(_('status code'), blank=True, null=True)
+    latency = models.PositiveIntegerField(_('latency in milliseconds'), blank=True, null=True)
+    error = models.CharField(_('error'), max_length=50, blank=True)
+
+    objects = LinkCheckHistoryManager()
+
+    def __str__(self):
+        return '{}: {}'.format(self.key, self.checked)
+
+    class Meta:
+        index_together = (('key', 'checked'),)
+        verbose_name = _('Link check')
+        verbose_name_plural = _('Link check history')
+
+
+class LinkCheckLease(models.Model):
+    """ Claim of a chunk of links by one of several check_links processes which share the work of a run. """
+    run = models.CharField(_('run'), max_length=100)
+    # a chunk covers the link ids from start to start + size - 1
+    start = models.PositiveIntegerField(_('first link id'))
+    size = models.PositiveIntegerField(_('chunk size'), default=0)
+    owner = models.CharField(_('owner'), max_length=255)
+    expires = models.DateTimeField(_('expires'))
+    finished = models.DateTimeField(_('finished'), blank=True, null=True)
+
+    def __str__(self):
+        return '{}: {}'.format(self.run, self.start)
+
+    class Meta:
+        unique_together = (('run', 'start'),)
+        verbose_name = _('Link check lease')
+        verbose_name_plural = _('Link check leases')
+
+
+class LinkCheckRun(models.Model):
+    """ Progress of a check_links run, so an interrupted run can be resumed. """
+    started = models.DateTimeField(_('started'), auto_now_add=True)
+    finished = models.DateTimeField(_('finished'), blank=True, null=True)
+    shard = models.CharField(_('shard'), max_length=20, blank=True)
+    last_link = models.PositiveIntegerField(_('last processed link id'), default=0)
+    counts = models.TextField(_('number of links per state'), default='{}')
+
+    def __str__(self):
+        return _('Link check run started on {}').format(self.started)
+
+    def get_counts(self):
+        return json.loads(self.counts)
+
+    def set_counts(self, counts):
+        self.counts = json.dumps(counts, sort_keys=True)
+
+    class Meta:
+        verbose_name = _('Link check run')
+        verbose_name_plural = _('Link check runs')
+
+
+class LinkCheckTaskManager(models.Manager):
+
+    def queue(self, link_ids):
+        """ Queues the given links for run_link_worker, links which are already queued are moved to the end. """
+        now = timezone.now()
+        queued = set(self.filter(link_id__in=link_ids).values_list('link_id', flat=True))
+        if queued:
+            self.filter(link_id__in=queued).update(created=now)
+        new = [link_id for link_id in link_ids if link_id not in queued]
+        try:
+            with transaction.atomic():
+                self.bulk_create([self.model(link_id=link_id, created=now) for link_id in new])
+        except IntegrityError:
+            # a concurrent save queued some of the links in the meantime
+            self.filter(link_id__in=new).update(created=now)
+            queued = set(self.filter(link_id__in=new).values_list('link_id', flat=True))
+            self.bulk_create([self.model(link_id=link_id, created=now) for link_id in new if link_id not in queued])
+
+
+class LinkCheckTask(models.Model):
+    """ A changed link which waits to be checked by the run_link_worker command. """
+    link = models.OneToOneField(FilerLink2Plugin, related_name='checktask', verbose_name=_('Link name'),
+                                on_delete=models.CASCADE)
+    created = models.DateTimeField(_('created'), db_index=True)
+
+    objects = LinkCheckTaskManager()
+
+    def __str__(self):
+        return _(u'Check task for: {}').format(self.link.name)
+
+    class Meta:
+        verbose_name = _('Link check task')
+        verbose_name_plural = _('Link check tasks')
+
+
+class LinkHealthSummaryManager(models.Manager):
+
+    def update_summary(self):
+        """ Replaces the summary of the current day with the numbers of the current link states. Every number is
+        computed with one aggregate query. """
+        now = timezone.now()
+        states = LinkHealthState.objects.all()
+        rows = []
+        for state, count in states.values_list('state').annotate(count=Count('pk')).order_by():
+            rows.append((self.model.STATE, state, count))
+
+        hosts = states.values_list('link__host').annotate(count=Count('pk')).order_by()
+        rows.extend((self.model.HOST, host, count) for host, count in hosts)
+
+        pages = states.filter(link__placeholder__page__publisher_is_draft=True).values_list(
+            'link__placeholder__page').annotate(count=Count('pk')).order_by()
+        rows.extend((self.model.PAGE, page_id, count) for page_id, count in pages)
+
+        age = Case(*[When(detected__gte=now - timedelta(days=days), then=Value(bucket))
+                     for bucket, days in self.model.AGES], default=Value(self.model.OLDER),
+                   output_field=models.CharField())
+        for bucket, count in states.annotate(age=age).values_list('age').annotate(count=Count('pk')).order_by():
+            rows.append((self.model.AGE, bucket, count))
+
+        date = timezone.localtime(now).date() if timezone.is_aware(now) else now.date()
+        with transaction.atomic():
+            self.filter(date=date).delete()
+            self.bulk_create([self.model(date=date, dimension=dimension, value=value, count=count)
+                              for dimension, value, count in rows])
+        days = getattr(settings, 'LINK_HEALTH_SUMMARY_DAYS', 365)
+        self.filter(date__lt=date - timedelta(days=days)).delete()
+
+
+class LinkHealthSummary(models.Model):
+    """ Number of faulty links per state, host, page and age on a day, written by check_links so the dashboard does
+    not need to count the link states. """
+    STATE = 'state'
+    HOST = 'host'
+    PAGE = 'page'
+    AGE = 'age'
+
+    DIMENSIONS = (
+        (STATE, _('State')),
+        (HOST, _('Host')),
+        (PAGE, _('Page')),
+        (AGE, _('Age')),
+    )
+
+    # buckets of the age dimension and their maximum age in days
+    AGES = (
+        ('day', 1),
+        ('week', 7),
+        ('month', 30),
+    )
+    OLDER = 'older'
+    AGE_NAMES = (
+        ('day', _('Less than a day')),
+        ('week', _('Less than a week')),
+        ('month', _('Less than a month')),
+        (OLDER, _('Older')),
+    )
+
+    date = models.DateField(_('date'))
+    dimension = models.CharField(_('dimension'), max_length=5, choices=DIMENSIONS)
+    value = models.CharField(_('value'), max_length=255, blank=True)
+    count = models.PositiveIntegerField(_('number of links'))
+
+    objects = LinkHealthSummaryManager()
+
+    def __str__(self):
+        return '{} {} {}: {}'.format(self.date, self.dimension, self.value, self.count)
+
+    class Meta:
+        unique_together = (('date', 'dimension', 'value'),)
+        verbose_name = _('Link health summary')
+        verbose_name_plural = _('Link health summaries')
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import defaultdict
+
+from django.apps import apps
+from django.core.cache import cache
+from django.db.models.signals import pre_delete
+from django.dispatch import receiver
+from django.urls import NoReverseMatch
+
+from cms import operations
+from cms.models import Page
+from cms.signals import post_obj_operation, post_publish, post_unpublish
+from cms.utils import get_current_site
+
+from filer.models import File
+
+from cmsplugin_filer_link2.models import FilerLink2Plugin, LinkHealthState
+from cmsplugin_filer_link2.utils import (
+    PAGE_URL_CACHE_KEY, get_page_url, invalidate_page_urls, prefetch_destinations, refresh_hrefs,
+)
+
+
+def get_affected_pages(page, descendants=True):
+    """ Returns the ids of the page and its descendants, draft and public versions, since the urls of all of them
+    depend on the page. """
+    pages = [page] + (list(page.get_descendant_pages()) if descendants else [])
+    page_ids = set(p.pk for p in pages)
+    page_ids.update(p.publisher_public_id for p in pages if p.publisher_public_id)
+    return page_ids
+
+
+def update_page_links(page_ids, language=None):
+    """ Brings the internal urls and link states of all links to the given pages up to date. Links are updated with
+    set-based queries and without calling save(), so rendering a link never needs to write anything. """
+    invalidate_page_urls(page_ids)
+    links = FilerLink2Plugin.objects.filter(page_link__in=page_ids)
+    if language:
+        links = links.filter(language=language)
+    links = list(links.values_list('pk', 'page_link', 'language', 'persistent_page_link'))
+    files, pages, states = prefetch_destinations((pk, None, page_id) for pk, page_id, language, url in links)
+
+    urls = {}
+    moved = defaultdict(list)
+    states = {}
+    for pk, page_id, link_language, persistent_page_link in links:
+        key = page_id, link_language
+        if key not in urls:
+            page = pages[page_id]
+            url = get_page_url(page_id, link_language, page)
+            # all titles of the page are loaded, a missing one would only be looked up again
+            urls[key] = url, url is not None and link_language in page.title_cache and page.is_published(link_language)
+        url, published = urls[key]
+        if url is not None and url != persistent_page_link:
+            moved[url].append(pk)
+        states[pk] = None if published else LinkHealthState.NOT_REACHABLE
+
+    for url, link_ids in moved.items():
+        FilerLink2Plugin.objects.filter(pk__in=link_ids).update(persistent_page_link=url)
+    LinkHealthState.objects.set_states(states)
+    refresh_hrefs(FilerLink2Plugin.objects.filter(pk__in=list(states)))
+
+
+def descendants_changed(page, language):
+    """ Whether publishing the page changed the links to its descendants: their urls depend on the path of the page and
+    descendants waiting for the page are published along with it. """
+    page_ids = get_affected_pages(page, descendants=False)
+    old_urls = set(
+        FilerLink2Plugin.objects.filter(page_link__in=page_ids, language=language).exclude(
+            persistent_page_link='').values_list('persistent_page_link', flat=True).distinct()[:2]
+    )
+    if not old_urls:
+        # without links to the page its previous url is only known while it is cached
+        old_urls.add(cache.get(PAGE_URL_CACHE_KEY.format(site=get_current_site().pk, page=page.pk, language=language)))
+    try:
+        url = page.get_absolute_url(language=language)
+    except NoReverseMatch:
+        url = None
+    if old_urls != {url}:
+        return True
+    return LinkHealthState.objects.filter(
+        link__page_link__in=get_affected_pages(page) - page_ids, link__language=language,
+        state=LinkHealthState.NOT_REACHABLE,
+    ).exists()
+
+
+@receiver(post_publish, dispatch_uid='link2_page_published')
+def page_published(sender, instance, language, **kwargs):
+    page = instance.get_draft_object()
+    update_page_links(get_affected_pages(page, descendants_changed(page, language)), language)
+
+
+@receiver(post_unpublish, dispatch_uid='link2_page_unpublished')
+def page_unpublished(sender, instance, language, **kwargs):
+    update_page_links(get_affected_pages(instance.get_draft_object()), language)
+
+
+@receiver(post_obj_operation, dispatch_uid='link2_page_moved')
+def page_moved(sender, operation, obj=None, **kwargs):
+    if operation == operations.MOVE_PAGE:
+        update_page_links(get_affected_pages(obj))
+
+
+@receiver(post_obj_operation, dispatch_uid='link2_page_translation_deleted')
+def page_translation_deleted(sender, operation, obj=None, translation=None, **kwargs):
+    # the page and its descendants are not reachable in this language anymore
+    if operation == operations.DELETE_PAGE_TRANSLATION:
+        update_page_links(get_affected_pages(obj), translation.language)
+
+
+@receiver(pre_delete, sender=Page, dispatch_uid='link2_page_deleted')
+def page_deleted(sender, instance, **kwargs):
+    # the page link is set to NULL, only the persisted url of the removed page remains (and stays the href)
+    invalidate_page_urls([instance.pk])
+    link_ids = FilerLink2Plugin.objects.filter(page_link=instance).values_list('pk', flat=True)
+    LinkHealthState.objects.set_states({link_id: LinkHealthState.NOT_REACHABLE for link_id in link_ids})
+
+
+def get_file_models():
+    """ Returns filer's File model and all its subclasses, e.g. images. Receivers are connected to each of them, since
+    receivers without a sender would run for every model (and disable fast deletes of all models). """
+    return [model for model in apps.get_models() if issubclass(model, File)]
+
+
+def file_saved(sender, instance, created, **kwargs):
+    # the url of a file changes e.g. when it is renamed or made private
+    if not created:
+        refresh_hrefs(FilerLink2Plugin.objects.filter(file=instance))
+
+
+def file_deleted(sender, instance, **kwargs):
+    # the file link is set to NULL, so these links do not point anywhere anymore
+    links = FilerLink2Plugin.objects.filter(file=instance)
+    link_ids = list(links.values_list('pk', flat=True))
+    links.update(resolved_href='', host='', url_path='')
+    LinkHealthState.objects.set_states({link_id: LinkHealthState.NOT_REACHABLE for link_id in link_ids})
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+try:
+    from urllib.parse import urlsplit
+except ImportError:  # Python 2
+    from urlparse import urlsplit
+
+from django.conf import settings
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.db.models import Case, Value, When
+from django.urls import NoReverseMatch
+
+from cms.models import Page, Title
+
+from filer.models import File
+from cms.utils import get_current_site
+
+PAGE_URL_CACHE_KEY = 'link2:page_url:{site}:{page}:{language}'
+
+
+def get_host(url):
+    """ Returns the host of an absolute url in lower case and an empty string for relative urls. """
+    return urlsplit(url or '').netloc.lower()[:255]
+
+
+def get_path(url):
+    """ Returns the path of a web url (absolute or relative) and an empty string for e.g. mailto links. """
+    parts = urlsplit(url or '')
+    return parts.path[:255] if parts.scheme in ('', 'http', 'https') else ''
+
+
+def is_cached(instance, field_name):
+    """ Whether the related object of a foreign key of the instance is loaded already, for all supported versions of
+    Django. """
+    descriptor = getattr(type(instance), field_name)
+    if hasattr(descriptor, 'is_cached'):
+        return descriptor.is_cached(instance)
+    # Django < 2.0
+    return hasattr(instance, descriptor.cache_name)
+
+
+def can_store_href(link):
+    """ Whether the href of a link may be stored. Storages which sign the urls of files (e.g. S3 with querystring auth)
+    return urls which expire, the hrefs of file links are resolved while rendering then. ``LINK_STORE_FILE_HREFS``
+    overrides the detection. """
+    if not link.file_id:
+        return True
+    store = getattr(settings, 'LINK_STORE_FILE_HREFS', None)
+    if store is None:
+        return not getattr(link.file.file.storage, 'querystring_auth', False)
+    return store
+
+
+def get_page_url(page_id, language, page=None):
+    """ Returns the url of a page in the given language. Urls are cached until the page is published, unpublished,
+    moved or deleted, so a cache hit does not need any database query.
+    :return: url or None if the url of the page cannot be resolved
+    """
+    key = PAGE_URL_CACHE_KEY.format(site=get_current_site().pk, page=page_id, language=language)
+    url = cache.get(key)
+    if url is None:
+        if page is None:
+            page = Page.objects.get(pk=page_id)
+        try:
+            url = page.get_absolute_url(language=language)
+        except NoReverseMatch:
+            url = ''
+        cache.set(key, url, getattr(settings, 'LINK_PAGE_URL_CACHE_TIMEOUT', 60 * 60))
+    return url or None
+
+
+def invalidate_page_urls(page_ids):
+    languages = [code for code, name in settings.LANGUAGES]
+    cache.delete_many([
+        PAGE_URL_CACHE_KEY.format(site=site_id, page=page_id, language=language)
+        for site_id in Site.objects.values_list('pk', flat=True)
+        for page_id in page_ids
+        for language in languages
+    ])
+
+
+def prefetch_destinations(links, with_states=False):
+    """ Loads the files, pages (with their titles) and, optionally, link states of the given links with a fixed number
+    of queries.
+    :param links: iterable of (link id, file id, page id)
+    :return: dicts of file id -> file, page id -> page and link id -> state
+    """
+    from cmsplugin_filer_link2.models import LinkHealthState
+
+    link_ids, file_ids, page_ids = set(), set(), set()
+    for link_id, file_id, page_id in links:
+        link_ids.add(link_id)
+        file_ids.add(file_id)
+        page_ids.add(page_id)
+    file_ids.discard(None)
+    page_ids.discard(None)
+
+    files = {f.pk: f for f in File.objects.filter(pk__in=file_ids)} if file_ids else {}
+    pages = {p.pk: p for p in Page.objects.filter(pk__in=page_ids)} if page_ids else {}
+    if pages:
+        for title in Title.objects.filter(page__in=pages):
+            pages[title.page_id].title_cache[title.language] = title
+    states = {}
+    if with_states:
+        states = {state.link_id: state for state in LinkHealthState.objects.filter(link__in=link_ids)}
+    return files, pages, states
+
+
+def refresh_hrefs(links, chunk_size=500):
+    """ Resolves the hrefs (and their hosts and paths) of the given links again and updates those which changed, one
+    query per chunk.
+    :param links: queryset of FilerLink2Plugin
+    """
+    from cmsplugin_filer_link2.models import FilerLink2Plugin
+
+    links = links.order_by('pk').select_related('file')
+    last_pk = 0
+    updated = 0
+    while True:
+        chunk = list(links.filter(pk__gt=last_pk)[:chunk_size])
+        if not chunk:
+            return updated
+        last_pk = chunk[-1].pk
+        # the pages with their titles, so resolving their urls needs no further queries
+        files, pages, states = prefetch_destinations((link.pk, None, link.page_link_id) for link in chunk)
+        for link in chunk:
+            if link.page_link_id in pages:
+                link.page_link = pages[link.page_link_id]
+        changed = {}
+        for link in chunk:
+            href = link.resolve_link()
+            # the host and path of links whose href is not stored are indexed nevertheless
+            values = (href if can_store_href(link) else ''), get_host(href), get_path(href)
+            if values != (link.resolved_href, link.host, link.url_path):
+                changed[link.pk] = values
+        if changed:
+            FilerLink2Plugin.objects.filter(pk__in=list(changed)).update(**{
+                field: Case(*[When(pk=pk, then=Value(values[i])) for pk, values in changed.items()])
+                for i, field in enumerate(('resolved_href', 'host', 'url_path'))
+            })
+            updated += len(changed)
@@ -0,0 +1,61 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from collections import OrderedDict
+
+from django.contrib.sites.models import Site
+from django.db.models import Case, IntegerField, Q, Value, When
+from django.http import JsonResponse
+from django.utils.translation import get_language
+
+from cms.models import Page, PagePermission, Title
+from cms.utils import get_current_site
+from cms.utils.page_permissions import get_view_id_list, user_can_view_all_pages
+
+from cmsplugin_filer_link2.fields import get_page_label
+
+PAGE_SEARCH_PAGE_SIZE = 20
+
+
+def page_search(request):
+    """ Select2 data source of the page picker: the pages whose title contains the search term, 20 per page. """
+    term = request.GET.get('term', '').strip()
+    try:
+        offset = (max(int(request.GET.get('page', 1)), 1) - 1) * PAGE_SEARCH_PAGE_SIZE
+    except ValueError:
+        offset = 0
+
+    pages = Page.objects.drafts().filter(title_set__title__icontains=term) if term else Page.objects.drafts()
+    # links may point to pages of all sites, the view permissions are checked per site
+    sites = {site.pk: site for site in Site.objects.all()}
+    restricted = PagePermission.objects.filter(can_view=True).values('page')
+    visible = Q()
+    for site in sites.values():
+        if user_can_view_all_pages(request.user, site):
+            visible |= Q(node__site=site)
+        else:
+            # pages with view restrictions are only listed for users who may see them
+            visible |= Q(node__site=site) & (Q(pk__in=get_view_id_list(request.user, site)) | ~Q(pk__in=restricted))
+    pages = pages.filter(visible)
+    # the pages of the current site first
+    current = Case(When(node__site=get_current_site(), then=Value(0)), default=Value(1), output_field=IntegerField())
+    page_sites = OrderedDict(
+        pages.annotate(current=current).order_by('current', 'node__site', 'node__path').values_list(
+            'pk', 'node__site').distinct()[offset:offset + PAGE_SEARCH_PAGE_SIZE + 1]
+    )
+    more = len(page_sites) > PAGE_SEARCH_PAGE_SIZE
+    page_ids = list(page_sites)[:PAGE_SEARCH_PAGE_SIZE]
+
+    # one title per page, preferably in the current language
+    language = get_language()
+    titles = {}
+    for title in Title.objects.filter(page__in=page_ids):
+        if title.page_id not in titles or title.language == language:
+            titles[title.page_id] = title
+    return JsonResponse({
+        'results': [
+            {'id': pk, 'text': get_page_label(None, titles[pk], sites.get(page_sites[pk]))}
+            for pk in page_ids if pk in titles
+        ],
+        'more': more,
+    })
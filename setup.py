@@ -23,10 +23,11 @@ setup(
     install_requires=[
         "Django >= 1.8",
         "django-filer >= 1.2.0",
-        "django-cms >= 3.1",
+        "django-cms >= 3.5",
         "djangocms-attributes-field",
         "django-select2<=6.3.1",
-        "requests"
+        "requests",
+        'futures; python_version < "3"',
     ],
     include_package_data=True,
     zip_safe=False,